@@ -0,0 +1,125 @@
+"""
+Бенчмарк отрисовки графиков: пул процессов ChartRenderPool против прежнего пути в потоках executor.
+Задачи получают синтетические строки в том же виде, что возвращает DBLayer, поэтому база не нужна.
+Параллельно с рендером работает поток-«пульс» с тиком 10 мс — так же, как heartbeat discord-шлюза
+или обработчик /roll в том же процессе; его задержка показывает, сколько рендер держит GIL.
+
+Примеры (из корня репозитория):
+    python -m benchmarks.bench_chart_render
+    python -m benchmarks.bench_chart_render --jobs 200 --concurrency 8 --workers 4 --players 12 --sessions 60
+"""
+
+import argparse
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from benchmarks.bench_roll_pipeline import percentile
+from layers.visualization_layer import ChartRenderPool
+
+TICK = 0.01
+
+
+def make_jobs(count, players, sessions, seed=42):
+    """Набор задач (chart, data, params) по всем видам графиков с данными заданного размера."""
+    rng = random.Random(seed)
+    names = [f"Player {i}" for i in range(players)]
+    session_ids = range(1, sessions + 1)
+    week = datetime(2025, 1, 6)
+    variants = [
+        ("average_rolls_by_session", [(s, rng.uniform(8, 13)) for s in session_ids], (False,)),
+        ("average_rolls_by_session", [(s, n, rng.uniform(8, 13)) for s in session_ids for n in names], (True,)),
+        ("average_rolls_by_player", [(n, rng.uniform(8, 13)) for n in names], (False, None)),
+        ("critical_rolls_by_player", [(n, rng.randint(0, 9), rng.randint(0, 9)) for n in names], (True, None)),
+        ("session_durations", [(s, rng.uniform(1, 4)) for s in session_ids], (False,)),
+        ("session_durations", [(week + timedelta(weeks=i), rng.uniform(2, 9)) for i in range(sessions)], (True,)),
+    ]
+    return [variants[i % len(variants)] for i in range(count)]
+
+
+class Heartbeat:
+    """Поток, который просыпается каждые TICK секунд и записывает, на сколько опоздал."""
+
+    def __init__(self):
+        self.lags = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        expected = time.perf_counter() + TICK
+        while not self._stop.is_set():
+            time.sleep(TICK)
+            now = time.perf_counter()
+            self.lags.append(max(0.0, now - expected))
+            expected = now + TICK
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_path(pool, jobs, concurrency):
+    latencies = []
+    lock = threading.Lock()
+
+    def job(item):
+        chart, data, params = item
+        started = time.perf_counter()
+        pool.render(chart, data, params)
+        with lock:
+            latencies.append(time.perf_counter() - started)
+
+    with Heartbeat() as heartbeat, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        started = time.perf_counter()
+        list(executor.map(job, jobs))
+        wall_time = time.perf_counter() - started
+
+    latencies.sort()
+    lags = sorted(heartbeat.lags)
+    return {
+        "wall_time_sec": wall_time,
+        "charts_per_sec": len(jobs) / wall_time,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "heartbeat_p99_lag_ms": (percentile(lags, 0.99) or 0.0) * 1000,
+        "heartbeat_max_lag_ms": (lags[-1] if lags else 0.0) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of chart rendering: process pool vs threads")
+    parser.add_argument("--jobs", type=int, default=60)
+    parser.add_argument("--concurrency", type=int, default=4, help="Одновременных команд (потоков executor бота)")
+    parser.add_argument("--workers", type=int, default=2, help="Процессов в пуле")
+    parser.add_argument("--players", type=int, default=8)
+    parser.add_argument("--sessions", type=int, default=30)
+    args = parser.parse_args()
+
+    jobs = make_jobs(args.jobs, args.players, args.sessions)
+    warmup = make_jobs(6, args.players, args.sessions, seed=7)
+    queue_size = max(args.concurrency, 1)
+
+    reports = {}
+    for name, workers in (("threads", 0), (f"processes x{args.workers}", args.workers)):
+        pool = ChartRenderPool(workers=workers, queue_size=queue_size, timeout=120)
+        try:
+            run_path(pool, warmup, args.concurrency)
+            reports[name] = run_path(pool, jobs, args.concurrency)
+        finally:
+            pool.close()
+
+    print(f"\n{args.jobs} charts, concurrency={args.concurrency}, {args.players} players x {args.sessions} sessions")
+    print(f"{'path':<16}{'wall s':>9}{'charts/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'hb p99 ms':>11}{'hb max ms':>11}")
+    for name, r in reports.items():
+        print(f"{name:<16}{r['wall_time_sec']:>9.2f}{r['charts_per_sec']:>10.1f}{r['p50_ms']:>10.1f}"
+              f"{r['p95_ms']:>10.1f}{r['heartbeat_p99_lag_ms']:>11.2f}{r['heartbeat_max_lag_ms']:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""
+Нагрузочный бенчмарк конвейера /roll.
+Прогоняет через APILayer запросы в том же виде, что отправляет sendResults из lua_scripts/dice_script.lua
+(URL-encoded JSON {player, results, total} с тремя костями), и печатает пропускную способность и p50/p95/p99
+по стадиям: decode, user_upsert, roll_insert, dice_inserts, rollup_upsert, commit, publish, spool_append.
+В режиме spool броски пишутся в спул во временном каталоге, replayer переносит их в базу параллельно;
+после запросов бенчмарк ждёт, пока спул опустеет, и отдельно печатает время этого хвоста и сквозную
+пропускную способность до базы, сравнимую с режимом sync.
+
+Примеры (из корня репозитория):
+    python -m benchmarks.bench_roll_pipeline
+    python -m benchmarks.bench_roll_pipeline --mode write_behind --requests 20000 --concurrency 8
+    python -m benchmarks.bench_roll_pipeline --mode spool --requests 20000
+    python -m benchmarks.bench_roll_pipeline --db postgres --dsn postgresql://postgres@localhost/bench
+    python -m benchmarks.bench_roll_pipeline --save-baseline benchmarks/baseline.json
+    python -m benchmarks.bench_roll_pipeline --baseline benchmarks/baseline.json --tolerance 0.2
+"""
+
+import argparse
+import json
+import random
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+
+from benchmarks.stand_ins import FakeBrokerLayer, PostgresDBLayer, SQLiteDBLayer, StageTimer
+from layers.api_layer import APILayer
+from layers.spool_layer import SpoolLayer
+
+PLAYERS = ["WTF BOOM", "Gloomhaven Enjoyer", "d20 Goblin", "Shadowrunner", "Nat One", "Critical Carl"]
+STAGES = ["decode", "user_upsert", "roll_insert", "dice_inserts", "rollup_upsert", "commit", "publish", "spool_append", "request"]
+
+
+def make_payloads(count, seed=42):
+    """Тела запросов как у sendResults: JSON.encode таблицы {player, results, total}."""
+    rng = random.Random(seed)
+    payloads = []
+    for _ in range(count):
+        results = [rng.randint(1, 6) for _ in range(3)]
+        roll_data = {"player": rng.choice(PLAYERS), "results": results, "total": sum(results)}
+        payloads.append(quote(json.dumps(roll_data)))
+    return payloads
+
+
+def drain_spool(spool_layer, timeout=120.0):
+    """Ждёт, пока replayer перенесёт в базу всё записанное в спул. Возвращает время ожидания (сек)."""
+    started = time.perf_counter()
+    spool_layer.flush()
+    while spool_layer.backlog_bytes() > 0:
+        if time.perf_counter() - started > timeout:
+            raise SystemExit(f"Spool was not drained in {timeout:.0f}s, {spool_layer.backlog_bytes()} bytes left")
+        time.sleep(0.01)
+    return time.perf_counter() - started
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(p * len(sorted_values)))]
+
+
+def summarize(timer, wall_time, requests):
+    report = {"requests": requests, "wall_time_sec": wall_time, "throughput_per_sec": requests / wall_time, "stages": {}}
+    for stage in STAGES:
+        values = sorted(timer.samples.get(stage, []))
+        if not values:
+            continue
+        report["stages"][stage] = {
+            "count": len(values),
+            "p50_ms": percentile(values, 0.50) * 1000,
+            "p95_ms": percentile(values, 0.95) * 1000,
+            "p99_ms": percentile(values, 0.99) * 1000,
+        }
+    return report
+
+
+def print_report(report, title):
+    print(f"\n{title}: {report['requests']} requests in {report['wall_time_sec']:.2f}s "
+          f"-> {report['throughput_per_sec']:.1f} rolls/s")
+    if "spool_drain_sec" in report:
+        print(f"spool drained {report['spool_drain_sec']:.2f}s after the last request "
+              f"-> {report['end_to_end_throughput_per_sec']:.1f} rolls/s into the database")
+    print(f"{'stage':<14}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, stats in report["stages"].items():
+        print(f"{stage:<14}{stats['count']:>8}{stats['p50_ms']:>10.3f}{stats['p95_ms']:>10.3f}{stats['p99_ms']:>10.3f}")
+
+
+def build_api(args, timer):
+    if args.db == "postgres":
+        if not args.dsn:
+            raise SystemExit("--dsn is required for --db postgres")
+        db_layer = PostgresDBLayer(timer, args.dsn)
+    else:
+        db_layer = SQLiteDBLayer(timer)
+    broker_layer = FakeBrokerLayer(timer)
+    spool_layer = None
+    if args.mode == "spool":
+        spool_layer = SpoolLayer(db_layer, tempfile.mkdtemp(prefix="bench_spool_"))
+        append_many = spool_layer.append_many
+
+        def timed_append_many(rolls_data):
+            with timer.measure("spool_append"):
+                append_many(rolls_data)
+        spool_layer.append_many = timed_append_many
+        spool_layer.start()
+    api_layer = APILayer(db_layer, broker_layer, ingest_mode=args.mode, spool_layer=spool_layer)
+
+    # Время декодирования снимаем обёрткой вокруг того же метода, что вызывает /roll
+    decode = api_layer.decode_request_data
+
+    def timed_decode():
+        with timer.measure("decode"):
+            return decode()
+    api_layer.decode_request_data = timed_decode
+    return api_layer, db_layer
+
+
+def run_benchmark(args):
+    timer = StageTimer()
+    api_layer, db_layer = build_api(args, timer)
+    payloads = make_payloads(args.requests)
+
+    # Разогрев: сессия, кэш игроков, первые запросы не попадают в статистику
+    warmup_client = api_layer.app.test_client()
+    warmup_client.post("/start_session")
+    for payload in make_payloads(args.warmup, seed=7):
+        warmup_client.post("/roll", data=payload)
+    # Разогревочные броски спула дописываются в базу до начала замера, иначе попадут в его статистику
+    if api_layer.spool_layer is not None:
+        drain_spool(api_layer.spool_layer)
+    timer.samples.clear()
+
+    errors = []
+    chunks = [payloads[i::args.concurrency] for i in range(args.concurrency)]
+
+    def worker(chunk):
+        client = api_layer.app.test_client()
+        for payload in chunk:
+            timer.begin_request()
+            started = time.perf_counter()
+            response = client.post("/roll", data=payload)
+            timer.add("request", time.perf_counter() - started)
+            timer.end_request()
+            if response.status_code != 200:
+                errors.append(response.status_code)
+
+    threads = [threading.Thread(target=worker, args=(chunk,)) for chunk in chunks]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - started
+    drain_time = None
+    if api_layer.spool_layer is not None:
+        # /roll в режиме spool отвечает до записи в базу: хвост переноса замеряется отдельно
+        drain_time = drain_spool(api_layer.spool_layer)
+        api_layer.spool_layer.close()
+    db_layer.close()
+
+    if errors:
+        raise SystemExit(f"{len(errors)} requests failed, first status: {errors[0]}")
+    report = summarize(timer, wall_time, args.requests)
+    if drain_time is not None:
+        report["spool_drain_sec"] = drain_time
+        report["end_to_end_throughput_per_sec"] = args.requests / (wall_time + drain_time)
+    return report
+
+
+def check_regression(report, baseline, tolerance):
+    """Возвращает список деградаций относительно сохранённой базовой линии."""
+    failures = []
+    if report["throughput_per_sec"] < baseline["throughput_per_sec"] * (1 - tolerance):
+        failures.append(f"throughput {report['throughput_per_sec']:.1f}/s < baseline "
+                        f"{baseline['throughput_per_sec']:.1f}/s")
+    for stage, stats in report["stages"].items():
+        base = baseline["stages"].get(stage)
+        if base and stats["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            failures.append(f"{stage} p95 {stats['p95_ms']:.3f}ms > baseline {base['p95_ms']:.3f}ms")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the /roll ingestion pipeline")
+    parser.add_argument("--mode", choices=("sync", "write_behind", "spool"), default="sync")
+    parser.add_argument("--db", choices=("sqlite", "postgres"), default="sqlite")
+    parser.add_argument("--dsn", help="DSN локального Postgres для --db postgres")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--output", help="Сохранить отчёт в JSON")
+    parser.add_argument("--save-baseline", help="Сохранить отчёт как базовую линию")
+    parser.add_argument("--baseline", help="Сравнить с базовой линией и завершиться с кодом 1 при деградации")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Допустимая деградация (доля)")
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    report["config"] = {"mode": args.mode, "db": args.db, "concurrency": args.concurrency}
+    print_report(report, f"/roll [{args.mode}, {args.db}, concurrency={args.concurrency}]")
+
+    for path in filter(None, (args.output, args.save_baseline)):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report saved to {path}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        failures = check_regression(report, baseline, args.tolerance)
+        if failures:
+            print("\nREGRESSION:")
+            for failure in failures:
+                print(f"  {failure}")
+            sys.exit(1)
+        print(f"\nNo regression against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+Локальные заменители удалённых сервисов для бенчмарков.
+Настоящий код DBLayer выполняется против SQLite в памяти или локального Postgres, а MsgBrokerLayer заменён
+фейком в памяти процесса. Все SQL-запросы проходят через TimingCursor, который раскладывает время по стадиям.
+"""
+
+import json
+import queue
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from layers.db_layer import SCHEMA_STATEMENTS, DataVersion, DBLayer, RecentRollIds, UserIdCache
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS sessions (
+        id {serial},
+        session_start TIMESTAMP,
+        session_end TIMESTAMP,
+        table_id TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id {serial},
+        user_name TEXT UNIQUE NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rolls (
+        id {serial},
+        user_id INTEGER REFERENCES users (id),
+        session_id INTEGER REFERENCES sessions (id),
+        total_result INTEGER,
+        roll_timestamp TIMESTAMP,
+        roll_uid TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS dice_results (
+        id {serial},
+        roll_id INTEGER REFERENCES rolls (id),
+        dice_result INTEGER
+    )
+    """,
+]
+
+# Стадия определяется по началу SQL-запроса
+STAGE_PREFIXES = [
+    ("INSERT INTO users", "user_upsert"),
+    ("INSERT INTO rolls", "roll_insert"),
+    ("INSERT INTO dice_results", "dice_inserts"),
+    ("INSERT INTO session_player_rollups", "rollup_upsert"),
+]
+
+
+class StageTimer:
+    """Собирает длительности стадий (в секундах). Несколько запросов одной стадии внутри вызова суммируются."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self._local = threading.local()
+
+    def begin_request(self):
+        self._local.current = defaultdict(float)
+
+    def add(self, stage, seconds):
+        current = getattr(self._local, "current", None)
+        if current is None:
+            with self._lock:
+                self.samples[stage].append(seconds)
+        else:
+            current[stage] += seconds
+
+    def end_request(self):
+        current = getattr(self._local, "current", None) or {}
+        self._local.current = None
+        with self._lock:
+            for stage, seconds in current.items():
+                self.samples[stage].append(seconds)
+
+    @contextmanager
+    def measure(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - started)
+
+
+class TimingCursor:
+    def __init__(self, cursor, timer, paramstyle="format"):
+        self._cursor = cursor
+        self._timer = timer
+        self._paramstyle = paramstyle
+
+    def execute(self, query, params=None):
+        statement = " ".join(query.split())
+        stage = next((name for prefix, name in STAGE_PREFIXES if statement.startswith(prefix)), "other_sql")
+        if self._paramstyle == "qmark":
+            query = query.replace("%s", "?")
+        with self._timer.measure(stage):
+            if params is None:
+                return self._cursor.execute(query)
+            return self._cursor.execute(query, params)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class TimingConnection:
+    def __init__(self, conn, timer, paramstyle="format"):
+        self._conn = conn
+        self._timer = timer
+        self._paramstyle = paramstyle
+
+    @property
+    def closed(self):
+        return getattr(self._conn, "closed", False)
+
+    def cursor(self, *args, **kwargs):
+        return TimingCursor(self._conn.cursor(*args, **kwargs), self._timer, self._paramstyle)
+
+    def commit(self):
+        with self._timer.measure("commit"):
+            self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+
+class SQLiteDBLayer(DBLayer):
+    """DBLayer поверх SQLite в памяти: выполняются те же методы и те же SQL-запросы, что и в продакшене."""
+
+    def __init__(self, timer, path=":memory:"):
+        self.timer = timer
+        self.pooled = False
+        self.pool = None
+        self.read_retries = 0
+        self.user_cache = UserIdCache()
+        self.recent_rolls = RecentRollIds()
+        self.data_version = DataVersion()
+        self.roll_listeners = []
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        for statement in SCHEMA:
+            self.conn.execute(statement.format(serial="INTEGER PRIMARY KEY AUTOINCREMENT"))
+        for statement in SCHEMA_STATEMENTS:
+            # ADD COLUMN IF NOT EXISTS в SQLite нет, нужные столбцы уже объявлены в SCHEMA
+            if not statement.startswith("ALTER TABLE"):
+                self.conn.execute(statement)
+        self.conn.commit()
+
+    @contextmanager
+    def _connection(self):
+        with self._lock:
+            yield TimingConnection(self.conn, self.timer, paramstyle="qmark")
+
+    def record_rolls_batch(self, rolls_data):
+        # execute_values есть только в psycopg2: в SQLite пачка пишется по одному броску
+        return sum(self.record_roll(roll_data) for roll_data in rolls_data)
+
+    def close(self):
+        self.conn.close()
+
+
+class PostgresDBLayer(DBLayer):
+    """Настоящий DBLayer, подключённый к локальному Postgres, с раскладкой времени запросов по стадиям."""
+
+    def __init__(self, timer, dsn, pooled=False):
+        self.timer = timer
+        super().__init__(pooled=pooled, connection_string=dsn)
+        with self._transaction() as cursor:
+            for statement in SCHEMA:
+                cursor.execute(statement.format(serial="SERIAL PRIMARY KEY"))
+        self.ensure_schema()
+
+    @contextmanager
+    def _connection(self):
+        with super()._connection() as conn:
+            yield TimingConnection(conn, self.timer)
+
+
+class FakeBrokerLayer:
+    """Заменитель MsgBrokerLayer: сериализует сообщение как настоящий и кладёт его в очередь в памяти."""
+
+    def __init__(self, timer):
+        self.timer = timer
+        self.messages = queue.Queue()
+
+    def process_request(self, command, data, wait=True):
+        with self.timer.measure("publish"):
+            self.messages.put((f"{command}_queue", json.dumps(data).encode()))
@@ -4,28 +4,94 @@
 '''
 
 
-from flask import Flask, request, send_from_directory
+from flask import Flask, Response, g, request, send_from_directory
+from werkzeug.serving import make_server
 import subprocess
+import threading
 import time
 import requests
 import os
 from dotenv import load_dotenv
 import json
+import hashlib
 from flasgger import Swagger
 import flasgger
 import markdown
 from urllib.parse import unquote
+from datetime import datetime
 import pika
+from layers.db_layer import make_roll_uid
+from layers.session_layer import SessionRegistry, resolve_table_id
+from layers.metrics_layer import log_payload, metrics
+
+# Режимы приёма бросков:
+# sync — /roll сразу пишет бросок в базу
+# write_behind — /roll только публикует бросок в очередь, в базу его пачками пишут консьюмеры MsgBrokerLayer
+# spool — /roll дописывает бросок в локальный спул (SpoolLayer), в базу его пачками переносит фоновый replayer
+INGEST_MODES = ("sync", "write_behind", "spool")
+# Предельная длина roll_id, присланного клиентом
+MAX_ROLL_ID_LENGTH = 128
+# Грани кубика: бросаются d6, результат вне диапазона в rollups и графики не пускаем
+DIE_FACES = range(1, 7)
+# Маршруты, которым нужны база и брокер: пока слои не подключены (attach), они отвечают 503
+READINESS_GATED_ROUTES = ("/start_session", "/end_session", "/roll", "/rolls/batch", "/broker/metrics",
+                          "/api/sessions", "/api/players", "/api/rolls", "/api/aggregates")
+# Размер страницы read API по умолчанию и предельный
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
 
 class APILayer:
-    def __init__(self, db_layer, broker_layer):
+    def __init__(self, db_layer, broker_layer, ingest_mode=None, spool_layer=None, stats_engine=None):
         self.app = Flask(__name__)
         self.db_layer = db_layer
-        self.current_session_id = 0
+        self.spool_layer = spool_layer
+        # Статистика бросков в памяти (StatsEngine) для /stats
+        self.stats_engine = stats_engine
+        # Активные сессии столов: один сервер обслуживает несколько столов одновременно
+        self.sessions = SessionRegistry()
+        load_dotenv()
+        self.ingest_mode = ingest_mode or os.getenv("INGEST_MODE", "sync")
+        if self.ingest_mode not in INGEST_MODES:
+            raise ValueError(f"Unknown ingest mode: {self.ingest_mode}. Expected one of {INGEST_MODES}")
+        # В режимах sync и write_behind броски, которые не удалось записать в базу или брокер, уходят в спул
+        self.spool_fallback = os.getenv("SPOOL_FALLBACK", "1") == "1"
+        # Публиковать ли события принятых бросков в fanout-обменник брокера (живая лента бота)
+        self.roll_events = os.getenv("ROLL_EVENTS", "0") == "1"
+        self.broker_layer = broker_layer
+        # Готовность к приёму бросков: сразу, если слои переданы, иначе после attach
+        self.ready = threading.Event()
+        if db_layer is not None:
+            self.ready.set()
+        # Проверки компонентов для /ready: имя -> функция без аргументов, возвращающая bool
+        self.readiness_checks = {}
+        self.server = None
+        self.server_thread = None
         self.setup_swagger()
+        self.setup_metrics()
+        self.setup_readiness()
         self.setup_routes()
+        self.setup_stats_routes()
+        self.setup_read_routes()
         self.setup_ngrok()
+
+    def attach(self, db_layer, broker_layer, spool_layer=None, stats_engine=None):
+        """Подключает слои, инициализированные после того, как сервер уже занял порт, и открывает приём бросков."""
+        self.db_layer = db_layer
         self.broker_layer = broker_layer
+        self.spool_layer = spool_layer
+        self.stats_engine = stats_engine
+        try:
+            # Сессии столов, начатые до перезапуска сервера, продолжают принимать броски
+            self.sessions.restore(db_layer.get_open_sessions())
+        except Exception as e:
+            print(f"APILayer: Could not restore table sessions: {e}")
+        self.ready.set()
+        print("APILayer: Ready to accept rolls")
 
     def connect_to_rabbitmq(self):
         # Устанавливаем соединение с RabbitMQ один раз при инициализации
@@ -55,7 +121,59 @@ class APILayer:
         }
         Swagger(self.app, config=swagger_config)
 
+    def setup_metrics(self):
+        # Время обработки каждого запроса по маршруту и коду ответа
+        @self.app.before_request
+        def start_timer():
+            g.request_started = time.perf_counter()
+
+        @self.app.after_request
+        def record_request(response):
+            started = g.get("request_started")
+            if started is not None:
+                route = request.url_rule.rule if request.url_rule else "unmatched"
+                metrics.observe("api_request_duration_seconds", time.perf_counter() - started, route=route)
+                metrics.inc("api_requests_total", route=route, status=response.status_code)
+            return response
+
+    def setup_readiness(self):
+        @self.app.before_request
+        def reject_until_ready():
+            if not self.ready.is_set() and request.path in READINESS_GATED_ROUTES:
+                return {"error": "Service is starting"}, 503, {"Retry-After": "1"}
+
+        @self.app.route('/ready', methods=['GET'])
+        def ready():
+            """
+            Readiness probe
+            ---
+            tags:
+              - Health
+            responses:
+              200:
+                description: Database (and broker in write-behind mode) are connected, rolls are accepted
+              503:
+                description: Service is still starting, ingestion routes answer 503
+            """
+            components = {name: bool(check()) for name, check in self.readiness_checks.items()}
+            if self.ready.is_set():
+                return {"status": "ready", "components": components}, 200
+            return {"status": "starting", "components": components}, 503
+
     def setup_routes(self):
+        @self.app.route('/metrics', methods=['GET'])
+        def prometheus_metrics():
+            """
+            Prometheus metrics
+            ---
+            tags:
+              - Metrics
+            responses:
+              200:
+                description: Counters and latency histograms of all layers in Prometheus text format
+            """
+            return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
         @self.app.route('/favicon.ico')
         def favicon():
             return send_from_directory(
@@ -80,10 +198,16 @@ class APILayer:
         @self.app.route('/start_session', methods=['POST'])
         def start_session():
             """
-            Start a new session
+            Start a new session for a table
             ---
             tags:
               - Session
+            parameters:
+              - in: header
+                name: X-Table-Id
+                type: string
+                required: false
+                description: Tabletop Simulator table; defaults to "default"
             responses:
               200:
                 description: Session started successfully
@@ -94,12 +218,17 @@ class APILayer:
                       type: string
                       example: success
             """
+            table_id, error = self.request_table_id()
+            if error:
+                return error
             try:
                 # Синхронный вызов DBLayer.start_session
-                session_id = self.db_layer.start_session()
-                self.current_session_id = session_id
-                print(f"APILayer: Session started with ID: {session_id}")
-                return {"status": "success", "session_id": session_id}, 200
+                session_id = self.db_layer.start_session(table_id)
+                previous = self.sessions.start(table_id, session_id, datetime.now())
+                if previous is not None:
+                    print(f"APILayer: Table {table_id} replaced session {previous.session_id}")
+                print(f"APILayer: Session started with ID: {session_id} for table {table_id}")
+                return {"status": "success", "session_id": session_id, "table": table_id}, 200
             except Exception as e:
                 print(f"APILayer: Error starting session: {e}")
                 return {"error": "Failed to start session"}, 500
@@ -107,10 +236,16 @@ class APILayer:
         @self.app.route('/end_session', methods=['POST'])
         def end_session():
             """
-            End current session
+            End the current session of a table
             ---
             tags:
               - Session
+            parameters:
+              - in: header
+                name: X-Table-Id
+                type: string
+                required: false
+                description: Tabletop Simulator table; defaults to "default"
             responses:
               200:
                 description: Session ended successfully
@@ -120,11 +255,32 @@ class APILayer:
                     status:
                       type: string
                       example: success
+              400:
+                description: The table has no active session
             """
+            table_id, error = self.request_table_id()
+            if error:
+                return error
+            # Сессия убирается из реестра только после записи: при ошибке стол продолжит принимать броски,
+            # а клиент сможет повторить /end_session
+            session = self.sessions.get(table_id)
+            if session is None:
+                print(f"APILayer: Error: No active session for table {table_id}")
+                return {"error": "No active session"}, 400
             try:
-                self.broker_layer.process_request("end_session", {})
-                print("APILayer: End session request sent")
-                return {"status": "Session end queued"}, 200
+                if self.write_behind:
+                    # Завершение идёт через свою очередь и может быть записано раньше бросков, ещё лежащих в пачках
+                    # консьюмеров: такие броски несут session_id и всё равно попадут в свою сессию, а время конца
+                    # фиксируется здесь, при приёме, поэтому session_end не зависит от отставания консьюмеров
+                    self.broker_layer.process_request("end_session", {"session_id": session.session_id,
+                                                                      "session_end": datetime.now().isoformat()})
+                    self.sessions.end(table_id, session.session_id)
+                    print(f"APILayer: End session request sent for table {table_id}")
+                    return {"status": "Session end queued"}, 200
+                self.db_layer.end_session(session.session_id)
+                self.sessions.end(table_id, session.session_id)
+                print(f"APILayer: Session {session.session_id} of table {table_id} ended")
+                return {"status": "success"}, 200
             except Exception as e:
                 print(f"APILayer: Error ending session: {e}")
                 return {"error": "Failed to end session"}, 500
@@ -137,6 +293,11 @@ class APILayer:
             tags:
               - Roll
             parameters:
+              - in: header
+                name: X-Table-Id
+                type: string
+                required: false
+                description: Tabletop Simulator table; defaults to "default"
               - in: body
                 name: body
                 required: true
@@ -154,6 +315,10 @@ class APILayer:
                     total:
                       type: integer
                       example: 12
+                    roll_id:
+                      type: string
+                      description: Client roll id; a repeated roll with the same id within the session is recorded once. Rolls without it are not deduplicated on retry
+                      example: 1718000000-000042
             responses:
               200:
                 description: Roll recorded successfully
@@ -172,47 +337,532 @@ class APILayer:
                       type: string
                       example: No active session
             """
-            if not self.current_session_id:
-                print("APILayer: Error: No active session! Please start a session with 'start'.")
-                return {"error": "No active session"}, 400
+            data, error = self.decode_request_data()
+            if error:
+                return error
+            session, error = self.active_session(data)
+            if error:
+                return error
+
+            # Проверяем наличие обязательных полей
+            if not self.has_roll_fields(data):
+                print(f"APILayer: Error: Missing or invalid fields in JSON: {data}")
+                return {"error": "Missing or invalid fields (player, results, total, roll_id)"}, 400
 
-                # Получаем сырые данные как строку
-            raw_data = request.get_data(as_text=True)
-            if not raw_data:
-                print("APILayer: Error: No data received")
-                return {"error": "No data provided"}, 400
+            roll_data = self.build_roll_data(data, session.session_id)
+            try:
+                status, _ = self.ingest_rolls([roll_data])
+                self.publish_roll_events(session.table_id, [roll_data])
+                return {"status": status}, 200
+            except Exception as e:
+                print(f"APILayer: Error processing roll: {e}")
+                return {"error": "Failed to process roll data"}, 500
+
+        @self.app.route('/broker/metrics', methods=['GET'])
+        def broker_metrics():
+            """
+            Publisher throughput and latency
+            ---
+            tags:
+              - Metrics
+            responses:
+              200:
+                description: Publisher counters, queue depth, confirm latency percentiles (ms) and throughput
+            """
+            return self.broker_layer.publisher.stats(), 200
 
+        @self.app.route('/rolls/batch', methods=['POST'])
+        def rolls_batch():
+            """
+            Record a batch of rolls
+            ---
+            tags:
+              - Roll
+            parameters:
+              - in: header
+                name: X-Table-Id
+                type: string
+                required: false
+                description: Tabletop Simulator table; defaults to "default"
+              - in: body
+                name: body
+                required: true
+                schema:
+                  type: object
+                  properties:
+                    rolls:
+                      type: array
+                      items:
+                        type: object
+                        properties:
+                          player:
+                            type: string
+                            example: WTF BOOM
+                          results:
+                            type: array
+                            items:
+                              type: integer
+                            example: [4, 5, 3]
+                          total:
+                            type: integer
+                            example: 12
+                          roll_id:
+                            type: string
+                            description: Client roll id; rolls without it are not deduplicated on retry
+                            example: 1718000000-000042
+            responses:
+              200:
+                description: Rolls recorded successfully
+                schema:
+                  type: object
+                  properties:
+                    status:
+                      type: string
+                      example: success
+                    recorded:
+                      type: integer
+                      description: Rolls inserted into the database, without duplicates of earlier rolls (sync mode)
+                      example: 25
+                    accepted:
+                      type: integer
+                      description: Rolls queued or spooled for a later write (write_behind and spool modes)
+                      example: 25
+              400:
+                description: No active session or invalid payload
+                schema:
+                  type: object
+                  properties:
+                    error:
+                      type: string
+                      example: No active session
+            """
+            data, error = self.decode_request_data()
+            if error:
+                return error
+            session, error = self.active_session(data)
+            if error:
+                return error
+
+            # Принимаем как голый список бросков, так и объект {"rolls": [...]}
+            rolls = data.get("rolls") if isinstance(data, dict) else data
+            if not isinstance(rolls, list) or not rolls:
+                print("APILayer: Error: Batch must contain a non-empty list of rolls")
+                return {"error": "Batch must contain a non-empty list of rolls"}, 400
+
+            for index, item in enumerate(rolls):
+                if not self.has_roll_fields(item):
+                    print(f"APILayer: Error: Missing or invalid fields in batch item {index}: {item}")
+                    error = f"Missing or invalid fields (player, results, total, roll_id) in item {index}"
+                    return {"error": error}, 400
+
+            rolls_data = [self.build_roll_data(item, session.session_id) for item in rolls]
+            try:
+                status, recorded = self.ingest_rolls(rolls_data)
+                self.publish_roll_events(session.table_id, rolls_data)
+                print(f"APILayer: Batch of {len(rolls_data)} rolls {'spooled' if status == 'spooled' else 'accepted'}")
+                if recorded is None:
+                    # Очередь или спул: сколько бросков окажется повторами, станет известно только при записи
+                    return {"status": status, "accepted": len(rolls_data)}, 200
+                return {"status": status, "recorded": recorded}, 200
+            except Exception as e:
+                print(f"APILayer: Error recording roll batch: {e}")
+                return {"error": "Failed to record roll batch"}, 500
+
+    def setup_stats_routes(self):
+        # Ответы собираются из памяти процесса, база не запрашивается
+        def stats_unavailable():
+            if self.stats_engine is None or not self.stats_engine.ready:
+                return {"error": "Statistics are not loaded yet"}, 503, {"Retry-After": "1"}
+            return None
+
+        @self.app.route('/stats', methods=['GET'])
+        def stats_overview():
+            """
+            All-time roll statistics
+            ---
+            tags:
+              - Stats
+            responses:
+              200:
+                description: All-time and per-player count, mean, variance, stddev, min, max and critical rolls
+              503:
+                description: Statistics are still being loaded from the database
+            """
+            return stats_unavailable() or (self.stats_engine.overview(), 200)
+
+        @self.app.route('/stats/sessions/<int:session_id>', methods=['GET'])
+        def stats_session(session_id):
+            """
+            Roll statistics of a session
+            ---
+            tags:
+              - Stats
+            parameters:
+              - in: path
+                name: session_id
+                type: integer
+                required: true
+            responses:
+              200:
+                description: Session and per-player statistics (count 0 if the session has no rolls)
+              503:
+                description: Statistics are still being loaded from the database
+            """
+            return stats_unavailable() or (self.stats_engine.session(session_id), 200)
+
+        @self.app.route('/stats/current', methods=['GET'])
+        def stats_current():
+            """
+            Roll statistics of a table's active session
+            ---
+            tags:
+              - Stats
+            parameters:
+              - in: header
+                name: X-Table-Id
+                type: string
+                required: false
+                description: Tabletop Simulator table; defaults to "default"
+            responses:
+              200:
+                description: Active session and per-player statistics
+              404:
+                description: The table has no active session
+            """
+            unavailable = stats_unavailable()
+            if unavailable:
+                return unavailable
+            table_id, error = self.request_table_id()
+            if error:
+                return error
+            session_id = self.sessions.session_id(table_id)
+            if not session_id:
+                return {"error": "No active session"}, 404
+            return dict(self.stats_engine.session(session_id), table=table_id), 200
+
+    def setup_read_routes(self):
+        """
+        Read API для внешних клиентов: сессии, игроки, броски и агрегаты.
+        Страницы выбираются по id (?after=<последний id прошлой страницы>&limit=), а не OFFSET'ом.
+        Каждый ответ несёт сильный ETag из версии таблицы, которую он читает (счётчики изменений строк
+        из статистики базы, DBLayer.get_table_versions), поэтому ETag одинаков во всех процессах API
+        и переживает перезапуск, а повторный запрос с If-None-Match до следующей записи получает 304
+        одним чтением статистики.
+        """
+        def page_params():
+            try:
+                after = int(request.args.get("after", 0))
+                limit = int(request.args.get("limit", PAGE_SIZE))
+            except ValueError:
+                return None, None, ({"error": "after and limit must be integers"}, 400)
+            if after < 0 or not 1 <= limit <= MAX_PAGE_SIZE:
+                return None, None, ({"error": f"after must be >= 0 and limit between 1 and {MAX_PAGE_SIZE}"}, 400)
+            return after, limit, None
+
+        def cached_page(tables, load_page):
+            """Отвечает 304, если ETag клиента совпал, иначе читает страницу через load_page()."""
+            # Версия берётся до запроса: запись, закоммиченная во время чтения, сменит ETag следующего ответа
+            try:
+                versions = ":".join(str(version) for version in self.db_layer.get_table_versions(tables))
+            except Exception as e:
+                print(f"APILayer: Failed to read table versions for {request.path}: {e}")
+                return {"error": "Failed to read data"}, 500
+            key = f"{versions}:{request.full_path}"
+            etag = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+            headers = {"ETag": f'"{etag}"', "Cache-Control": "no-cache"}
+            if request.if_none_match.contains_weak(etag):
+                metrics.inc("api_not_modified_total", route=request.url_rule.rule)
+                return "", 304, headers
+            try:
+                items, next_after = load_page()
+            except Exception as e:
+                print(f"APILayer: Failed to read {request.path}: {e}")
+                return {"error": "Failed to read data"}, 500
+            return {"items": items, "next_after": next_after}, 200, headers
+
+        def next_after(ids, limit):
+            # Неполная страница — последняя
+            return ids[-1] if len(ids) == limit else None
+
+        def isoformat(value):
+            return value.isoformat() if value is not None else None
+
+        @self.app.route('/api/sessions', methods=['GET'])
+        def api_sessions():
+            """
+            Sessions, oldest first
+            ---
+            tags:
+              - Read API
+            parameters:
+              - in: query
+                name: after
+                type: integer
+                description: next_after of the previous page
+              - in: query
+                name: limit
+                type: integer
+                description: Page size, 100 by default, at most 1000
+              - in: header
+                name: If-None-Match
+                type: string
+                description: ETag of a previously received page
+            responses:
+              200:
+                description: Page of sessions and next_after (null on the last page)
+              304:
+                description: The page has not changed since the ETag was issued
+              400:
+                description: Invalid after or limit
+            """
+            after, limit, error = page_params()
+            if error:
+                return error
+
+            def load_page():
+                rows = self.db_layer.get_sessions_page(after, limit)
+                items = [{"id": session_id, "table": table_id, "start": isoformat(start), "end": isoformat(end)}
+                         for session_id, table_id, start, end in rows]
+                return items, next_after([row[0] for row in rows], limit)
+
+            return cached_page(("sessions",), load_page)
+
+        @self.app.route('/api/players', methods=['GET'])
+        def api_players():
+            """
+            Players, in order of their first roll
+            ---
+            tags:
+              - Read API
+            parameters:
+              - in: query
+                name: after
+                type: integer
+              - in: query
+                name: limit
+                type: integer
+              - in: header
+                name: If-None-Match
+                type: string
+            responses:
+              200:
+                description: Page of players and next_after (null on the last page)
+              304:
+                description: The page has not changed since the ETag was issued
+              400:
+                description: Invalid after or limit
+            """
+            after, limit, error = page_params()
+            if error:
+                return error
+
+            def load_page():
+                rows = self.db_layer.get_players_page(after, limit)
+                items = [{"id": user_id, "name": user_name} for user_id, user_name in rows]
+                return items, next_after([row[0] for row in rows], limit)
+
+            return cached_page(("users",), load_page)
+
+        @self.app.route('/api/rolls', methods=['GET'])
+        def api_rolls():
+            """
+            Rolls with their dice, oldest first
+            ---
+            tags:
+              - Read API
+            parameters:
+              - in: query
+                name: session
+                type: integer
+                description: Only rolls of this session
+              - in: query
+                name: after
+                type: integer
+              - in: query
+                name: limit
+                type: integer
+              - in: header
+                name: If-None-Match
+                type: string
+            responses:
+              200:
+                description: Page of rolls and next_after (null on the last page)
+              304:
+                description: The page has not changed since the ETag was issued
+              400:
+                description: Invalid session, after or limit
+            """
+            after, limit, error = page_params()
+            if error:
+                return error
+            session_id = request.args.get("session", type=int)
+            if "session" in request.args and session_id is None:
+                return {"error": "session must be an integer"}, 400
+
+            def load_page():
+                rows = self.db_layer.get_rolls_page(after, limit, session_id)
+                items = [{"id": roll_id, "session_id": roll_session_id, "player": player, "total": total,
+                          "timestamp": isoformat(timestamp), "results": list(results)}
+                         for roll_id, roll_session_id, player, total, timestamp, results in rows]
+                return items, next_after([row[0] for row in rows], limit)
+
+            return cached_page(("rolls",), load_page)
+
+        @self.app.route('/api/aggregates', methods=['GET'])
+        def api_aggregates():
+            """
+            Per-session, per-player roll aggregates
+            ---
+            tags:
+              - Read API
+            parameters:
+              - in: query
+                name: after
+                type: integer
+                description: next_after of the previous page (a session id)
+              - in: query
+                name: limit
+                type: integer
+                description: Sessions per page, 100 by default, at most 1000
+              - in: header
+                name: If-None-Match
+                type: string
+            responses:
+              200:
+                description: Page of sessions with per-player count, sum, mean and critical rolls
+              304:
+                description: The page has not changed since the ETag was issued
+              400:
+                description: Invalid after or limit
+            """
+            after, limit, error = page_params()
+            if error:
+                return error
+
+            def load_page():
+                sessions = {}
+                for session_id, player, count, total, success, failure in self.db_layer.get_rollups_page(after, limit):
+                    players = sessions.setdefault(session_id, [])
+                    if player is not None:
+                        players.append({"player": player, "count": count, "sum": total,
+                                        "mean": round(total / count, 4) if count else None,
+                                        "critical_success": success, "critical_failure": failure})
+                items = [{"session_id": session_id, "players": players} for session_id, players in sessions.items()]
+                return items, next_after(list(sessions), limit)
+
+            return cached_page(("sessions", "rollups"), load_page)
+
+    @property
+    def write_behind(self):
+        return self.ingest_mode == "write_behind"
+
+    @property
+    def uses_spool(self):
+        """Нужен ли этому серверу SpoolLayer: как основной путь приёма или как запасной при сбоях."""
+        return self.ingest_mode == "spool" or self.spool_fallback
+
+    def ingest_rolls(self, rolls_data):
+        """
+        Принимает броски согласно режиму приёма. Если база или брокер недоступны, а спул подключён,
+        броски дописываются в спул вместо ошибки. Возвращает (статус, записано): статус "success" или "spooled",
+        записано — число бросков, действительно вставленных в базу без повторов, в режиме sync и None, если
+        броски только поставлены в очередь или спул и запишутся позже.
+        """
+        try:
+            if self.ingest_mode == "spool":
+                self.spool_layer.append_many(rolls_data)
+            elif self.write_behind:
+                # Запись в базу выполнят консьюмеры брокера
+                for roll_data in rolls_data:
+                    self.broker_layer.process_request("roll", roll_data)
+                    log_payload("APILayer: Roll data sent: ", roll_data)
+            elif len(rolls_data) == 1:
+                return "success", int(self.db_layer.record_roll(rolls_data[0]))
+            else:
+                return "success", self.db_layer.record_rolls_batch(rolls_data)
+            return "success", None
+        except Exception as e:
+            if self.ingest_mode == "spool" or self.spool_layer is None:
+                raise
+            print(f"APILayer: Ingestion failed, spooling {len(rolls_data)} rolls: {e}")
+            metrics.inc("spool_fallback_total", len(rolls_data))
+            self.spool_layer.append_many(rolls_data)
+            return "spooled", None
+
+    def decode_request_data(self):
+        """Декодирует URL-encoded JSON из тела запроса. Возвращает (данные, ответ_с_ошибкой)."""
+        # Получаем сырые данные как строку
+        raw_data = request.get_data(as_text=True)
+        if not raw_data:
+            print("APILayer: Error: No data received")
+            return None, ({"error": "No data provided"}, 400)
+
+        with metrics.timer("api_stage_duration_seconds", stage="decode"):
             # Декодируем URL-encoded строку
             decoded_data = unquote(raw_data)
-            print("APILayer: Decoded data: " + decoded_data)
+            log_payload("APILayer: Decoded data: ", decoded_data)
 
             # Проверяем, что данные — это валидный JSON
             try:
-                data = json.loads(decoded_data)
+                return json.loads(decoded_data), None
             except json.JSONDecodeError:
                 print("APILayer: Error: Decoded data is not valid JSON: " + decoded_data)
-                return {"error": "Invalid JSON"}, 400
+                return None, ({"error": "Invalid JSON"}, 400)
 
-            # Проверяем наличие обязательных полей
-            if not all(key in data for key in ["player", "results", "total"]):
-                print("APILayer: Error: Missing required fields in JSON: " + decoded_data)
-                return {"error": "Missing required fields (player, results, total)"}, 400
-
-            roll_data = {
-                "player": data['player'],
-                "results": data['results'],
-                "total": data['total'],
-                "session_id": self.current_session_id
-            }
-            self.db_layer.record_roll(roll_data)
+    @staticmethod
+    def has_roll_fields(data):
+        if not isinstance(data, dict) or not all(key in data for key in ["player", "results", "total"]):
+            return False
+        # bool — подкласс int, но true/false в JSON броском не является
+        if not is_int(data["total"]):
+            return False
+        results = data["results"]
+        if not isinstance(results, list) or not results or not all(is_int(r) and r in DIE_FACES for r in results):
+            return False
+        # Необязательный roll_id клиента — строка или число разумной длины
+        roll_id = data.get("roll_id")
+        return roll_id is None or (isinstance(roll_id, (str, int)) and len(str(roll_id)) <= MAX_ROLL_ID_LENGTH)
 
-            try:
-                self.broker_layer.process_request("roll", roll_data)
-                print(f"APILayer: Roll data sent: {roll_data}")
-                return {"status": "success"}, 200
-            except Exception as e:
-                print(f"APILayer: Error processing roll: {e}")
-                return {"error": "Failed to process roll data"}, 500
+    def request_table_id(self, data=None):
+        """Стол запроса: заголовок X-Table-Id, параметр ?table= или поле table тела. Возвращает (стол, ошибка)."""
+        try:
+            return resolve_table_id(request.headers.get("X-Table-Id") or request.args.get("table"), data), None
+        except ValueError as e:
+            print(f"APILayer: Error: {e}")
+            return None, ({"error": str(e)}, 400)
+
+    def active_session(self, data):
+        """Активная сессия (TableSession) стола запроса. Возвращает (сессия, ответ_с_ошибкой)."""
+        table_id, error = self.request_table_id(data)
+        if error:
+            return None, error
+        session = self.sessions.get(table_id)
+        if session is None:
+            print(f"APILayer: Error: No active session for table {table_id}! Please start a session with 'start'.")
+            return None, ({"error": "No active session"}, 400)
+        return session, None
+
+    def publish_roll_events(self, table_id, rolls_data):
+        """События принятых бросков для живой ленты бота. Лента не должна мешать приёму: ошибки только в лог."""
+        if not self.roll_events or self.broker_layer is None:
+            return
+        try:
+            self.broker_layer.publish_roll_events([dict(roll_data, table=table_id) for roll_data in rolls_data])
+        except Exception as e:
+            print(f"APILayer: Error publishing roll events: {e}")
+
+    def build_roll_data(self, data, session_id):
+        roll_data = {
+            "player": data['player'],
+            "results": data['results'],
+            "total": data['total'],
+            "session_id": session_id,
+            # Время фиксируется при приёме, а не при записи в базу, которая в write-behind происходит позже
+            "timestamp": datetime.now().isoformat()
+        }
+        # Идентичность фиксируется при приёме из полей клиента и едет с броском через брокер и спул
+        roll_data["roll_uid"] = make_roll_uid(roll_data, data.get("roll_id"))
+        return roll_data
 
 
     def setup_ngrok(self):
@@ -226,6 +876,8 @@ class APILayer:
             self.NGROK_PATH = None
         self.PORT = 5000
         self.STATIC_DOMAIN = "relieved-firm-titmouse.ngrok-free.app"
+        # Сколько секунд ждать появления туннеля
+        self.NGROK_START_TIMEOUT = float(os.getenv("NGROK_START_TIMEOUT", "15"))
 
     def start_ngrok(self):
         if not self.NGROK_PATH:
@@ -241,9 +893,13 @@ class APILayer:
                 stderr=log_file,
                 text=True
             )
-        for i in range(15):
+        # Опрашиваем API ngrok с растущей паузой: туннель обычно поднимается за доли секунды,
+        # а при медленном старте не забиваем цикл частыми запросами
+        deadline = time.monotonic() + self.NGROK_START_TIMEOUT
+        delay = 0.1
+        while True:
             try:
-                response = requests.get("http://127.0.0.1:4040/api/tunnels")
+                response = requests.get("http://127.0.0.1:4040/api/tunnels", timeout=1)
                 tunnels = response.json().get("tunnels", [])
                 if tunnels:
                     public_url = tunnels[0]["public_url"]
@@ -252,10 +908,26 @@ class APILayer:
                     print(f"APILayer: Swagger UI available at: {public_url}/apidocs")
                     print(f"APILayer: RabbitMQ at http://localhost:15672")
                     return public_url
-            except requests.ConnectionError:
-                time.sleep(1)
-        print(f"APILayer: Failed to get ngrok URL after 15 seconds. Check {log_file_path} for details.")
+            except (requests.ConnectionError, requests.Timeout):
+                pass
+            if time.monotonic() + delay > deadline:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, 2.0)
+        print(f"APILayer: Failed to get ngrok URL after {self.NGROK_START_TIMEOUT:g} seconds. Check {log_file_path} for details.")
         return None
 
+    def start_server(self):
+        """Сразу занимает порт и обслуживает запросы в фоновом потоке. Возвращает поток сервера."""
+        self.server = make_server("0.0.0.0", self.PORT, self.app, threaded=True)
+        self.server_thread = threading.Thread(target=self.server.serve_forever, name="http-server", daemon=True)
+        self.server_thread.start()
+        print(f"APILayer: Listening on port {self.PORT}")
+        return self.server_thread
+
+    def stop_server(self):
+        if self.server is not None:
+            self.server.shutdown()
+
     def run(self):
         self.app.run(host="0.0.0.0", port=self.PORT)
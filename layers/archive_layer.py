@@ -0,0 +1,346 @@
+"""
+Данный модуль выгружает историю игр (sessions, users, rolls, dice_results) в файлы и загружает её обратно.
+Выгрузка идёт через COPY ... TO STDOUT прямо в файл CSV или серверным курсором порциями в Parquet, все таблицы
+читаются в одном снимке REPEATABLE READ. Загрузка копирует файлы через COPY во временные таблицы и одной
+транзакцией переносит их в основные: игроки находятся или создаются по имени, сессии и броски получают новые id
+из последовательностей базы, кости и агрегаты session_player_rollups пересчитываются на новые id.
+Бросок, чей roll_uid уже есть в базе, пропускается, а сессия с тем же началом и столом, что уже есть в базе,
+не создаётся второй раз (её броски добавляются к существующей), поэтому повторная загрузка той же выгрузки
+ничего не задвоит.
+Так же загружаются журналы бросков в формате JSON Lines (например, rejected.jsonl спула): по броску на строку,
+как в теле /roll, с полями session_id, table и timestamp, по которым броски группируются в сессии.
+Память не зависит от объёма истории: в ней лежит одна порция строк.
+Статистика /stats уже работающего сервера увидит загруженную историю после его перезапуска.
+
+Запуск (из корня репозитория):
+    python main_manager.py --export backup/ --export-format parquet
+    python main_manager.py --import backup/
+    python main_manager.py --import-log rolls.jsonl
+"""
+
+import csv
+import io
+import json
+import os
+from datetime import datetime
+
+from layers.db_layer import CRITICAL_FAILURE, CRITICAL_SUCCESS, ROLLUP_UPSERT, make_roll_uid, roll_timestamp
+from layers.session_layer import DEFAULT_TABLE
+
+# Выгружаемые таблицы и их колонки в порядке загрузки (родительские таблицы раньше дочерних)
+ARCHIVE_TABLES = {
+    "sessions": ("id", "session_start", "session_end", "table_id"),
+    "users": ("id", "user_name"),
+    "rolls": ("id", "user_id", "session_id", "total_result", "roll_timestamp", "roll_uid"),
+    "dice_results": ("id", "roll_id", "dice_result"),
+}
+ARCHIVE_FORMATS = ("csv", "parquet")
+# roll_uid исторического броска (до появления roll_uid): хэш его id, сессии, игрока, времени, суммы и костей.
+# id в ключе различает настоящие одинаковые броски (3d6 с той же суммой в ту же секунду); при возврате
+# выгрузки в исходную базу id совпадают, у журнала бросков id — порядковый номер строки
+HISTORICAL_ROLL_UID = """
+    UPDATE {prefix}rolls r
+    SET roll_uid = k.roll_uid
+    FROM (
+        SELECT r.id, 'i:' || md5(concat_ws('|', r.id, s.session_start, s.table_id, u.user_name, r.roll_timestamp,
+            r.total_result,
+            (SELECT string_agg(d.dice_result::text, ',' ORDER BY d.id)
+             FROM {prefix}dice_results d WHERE d.roll_id = r.id))) AS roll_uid
+        FROM {prefix}rolls r
+        LEFT JOIN {prefix}sessions s ON s.id = r.session_id
+        LEFT JOIN {prefix}users u ON u.id = r.user_id
+        WHERE r.roll_uid IS NULL
+    ) k
+    WHERE r.id = k.id
+"""
+MANIFEST = "manifest.json"
+
+
+def import_pyarrow():
+    """pyarrow нужен только для Parquet, CSV работает без него."""
+    try:
+        import pyarrow
+        import pyarrow.csv
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Parquet archives need pyarrow: pip install pyarrow") from None
+    return pyarrow
+
+
+def parquet_schema(pa, table):
+    types = {
+        "id": pa.int64(), "user_id": pa.int64(), "session_id": pa.int64(), "roll_id": pa.int64(),
+        "total_result": pa.int32(), "dice_result": pa.int32(),
+        "session_start": pa.timestamp("us"), "session_end": pa.timestamp("us"), "roll_timestamp": pa.timestamp("us"),
+        "table_id": pa.string(), "user_name": pa.string(), "roll_uid": pa.string(),
+    }
+    return pa.schema([(column, types[column]) for column in ARCHIVE_TABLES[table]])
+
+
+class ArchiveLayer:
+    def __init__(self, db_layer, chunk_rows=None):
+        self.db_layer = db_layer
+        # Строк в одной порции Parquet и в одном COPY журнала бросков
+        self.chunk_rows = chunk_rows or db_layer.stream_itersize
+
+    # --- Выгрузка ---
+
+    def export(self, directory, fmt="csv"):
+        """Выгружает таблицы истории в directory (по файлу на таблицу и manifest.json). Возвращает число строк."""
+        if fmt not in ARCHIVE_FORMATS:
+            raise ValueError(f"Unknown archive format: {fmt}. Expected one of {ARCHIVE_FORMATS}")
+        pa = import_pyarrow() if fmt == "parquet" else None
+        os.makedirs(directory, exist_ok=True)
+        counts = {}
+        # Один снимок на все таблицы: бросок, записанный во время выгрузки, не окажется без своих костей
+        with self.db_layer.snapshot() as cursor:
+            for table, columns in ARCHIVE_TABLES.items():
+                query = f"SELECT {', '.join(columns)} FROM {table} ORDER BY id"
+                path = os.path.join(directory, f"{table}.{fmt}")
+                if pa is None:
+                    with open(path, "w", encoding="utf-8", newline="") as file:
+                        counts[table] = self.db_layer.copy_to_csv(cursor, query, file)
+                else:
+                    counts[table] = self._export_parquet(pa, cursor.connection, table, query, path)
+                print(f"ArchiveLayer: Exported {counts[table]} rows of {table}")
+        with open(os.path.join(directory, MANIFEST), "w", encoding="utf-8") as file:
+            json.dump({"format": fmt, "exported_at": datetime.now().isoformat(), "tables": counts}, file, indent=2)
+        return counts
+
+    def _export_parquet(self, pa, conn, table, query, path):
+        schema = parquet_schema(pa, table)
+        cursor = conn.cursor(name=f"dicebot_export_{table}")
+        cursor.itersize = self.chunk_rows
+        count = 0
+        with pa.parquet.ParquetWriter(path, schema) as writer:
+            cursor.execute(query)
+            while True:
+                rows = cursor.fetchmany(self.chunk_rows)
+                if not rows:
+                    break
+                columns = zip(*rows)
+                writer.write_batch(pa.RecordBatch.from_arrays(
+                    [pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema))
+                count += len(rows)
+        cursor.close()
+        return count
+
+    # --- Загрузка ---
+
+    def import_archive(self, directory):
+        """Загружает выгрузку из directory. Формат берётся из manifest.json или по расширениям файлов."""
+        manifest_path = os.path.join(directory, MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, encoding="utf-8") as file:
+                fmt = json.load(file)["format"]
+        else:
+            fmt = "parquet" if os.path.exists(os.path.join(directory, "rolls.parquet")) else "csv"
+        pa = import_pyarrow() if fmt == "parquet" else None
+
+        def load(cursor):
+            for table, columns in ARCHIVE_TABLES.items():
+                path = os.path.join(directory, f"{table}.{fmt}")
+                if not os.path.exists(path):
+                    raise FileNotFoundError(f"Archive has no {table}.{fmt}")
+                if pa is None:
+                    with open(path, encoding="utf-8", newline="") as file:
+                        self.db_layer.copy_from_csv(cursor, f"import_{table}", columns, file)
+                    continue
+                for batch in pa.parquet.ParquetFile(path).iter_batches(batch_size=self.chunk_rows, columns=list(columns)):
+                    # Порция Parquet уходит в COPY как CSV из памяти
+                    buffer = io.BytesIO()
+                    pa.csv.write_csv(pa.Table.from_batches([batch]), buffer)
+                    buffer.seek(0)
+                    self.db_layer.copy_from_csv(cursor, f"import_{table}", columns, buffer)
+
+        return self._import(load, directory)
+
+    def import_roll_log(self, paths):
+        """
+        Загружает журналы бросков JSON Lines. Броски одной пары (table, session_id) становятся одной новой сессией
+        с началом и концом по первому и последнему броску. Бросок без timestamp пропускается: его время
+        не восстановить, а время загрузки дало бы при каждой загрузке новую сессию и новый roll_uid.
+        """
+        def load(cursor):
+            sessions, users = {}, {}
+            roll_id = dice_id = 0
+            chunk = {"rolls": [], "dice_results": []}
+            for path in paths:
+                with open(path, encoding="utf-8") as file:
+                    for line_number, line in enumerate(file, 1):
+                        if not line.strip():
+                            continue
+                        try:
+                            roll_data = json.loads(line)
+                            player, total = roll_data["player"], int(roll_data["total"])
+                            results = [int(result) for result in roll_data["results"]]
+                            if not roll_data.get("timestamp"):
+                                raise ValueError("roll has no timestamp")
+                            timestamp = roll_timestamp(roll_data)
+                            roll_data.setdefault("session_id", None)
+                        except (ValueError, KeyError, TypeError) as e:
+                            print(f"ArchiveLayer: Skipping {path}:{line_number}: {e}")
+                            continue
+                        key = (roll_data.get("table") or DEFAULT_TABLE, roll_data.get("session_id"))
+                        session = sessions.get(key)
+                        if session is None:
+                            session = sessions[key] = [len(sessions) + 1, timestamp, timestamp]
+                        session[1], session[2] = min(session[1], timestamp), max(session[2], timestamp)
+                        user_id = users.setdefault(player, len(users) + 1)
+                        roll_uid = roll_data.get("roll_uid") or make_roll_uid(roll_data, roll_data.get("roll_id"))
+                        roll_id += 1
+                        chunk["rolls"].append((roll_id, user_id, session[0], total, timestamp, roll_uid))
+                        for result in results:
+                            dice_id += 1
+                            chunk["dice_results"].append((dice_id, roll_id, result))
+                        if len(chunk["rolls"]) >= self.chunk_rows:
+                            self._copy_rows(cursor, chunk)
+            self._copy_rows(cursor, chunk)
+            self._copy_rows(cursor, {
+                "sessions": [(session_id, start, end, table_id)
+                             for (table_id, _), (session_id, start, end) in sessions.items()],
+                "users": [(user_id, player) for player, user_id in users.items()],
+            })
+
+        return self._import(load, ", ".join(paths))
+
+    def _copy_rows(self, cursor, tables):
+        """Копирует накопленные строки в промежуточные таблицы и очищает списки."""
+        for table, rows in tables.items():
+            if not rows:
+                continue
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(ARCHIVE_TABLES[table])
+            # None пишется пустым полем без кавычек — в COPY это NULL
+            writer.writerows(rows)
+            buffer.seek(0)
+            self.db_layer.copy_from_csv(cursor, f"import_{table}", ARCHIVE_TABLES[table], buffer)
+            rows.clear()
+
+    def _import(self, load, source):
+        with self.db_layer.bulk_transaction() as cursor:
+            for table in ARCHIVE_TABLES:
+                # Промежуточные таблицы без ограничений и последовательностей, удаляются вместе с транзакцией
+                cursor.execute(f"CREATE TEMP TABLE import_{table} (LIKE {table}) ON COMMIT DROP")
+            load(cursor)
+            counts = self._merge(cursor)
+        self.db_layer.user_cache.clear()
+        self.db_layer.data_version.bump()
+        print(f"ArchiveLayer: Imported {source}: {counts['sessions']} sessions, {counts['users']} new players, "
+              f"{counts['rolls']} rolls, {counts['dice_results']} dice, {counts['skipped']} rolls already present")
+        return counts
+
+    def _merge(self, cursor):
+        """Переносит промежуточные таблицы в основные с новыми id. Возвращает число записанных строк."""
+        # У временных таблиц нет автоматического ANALYZE, без статистики планы соединений будут вложенными циклами
+        cursor.execute("CREATE INDEX ON import_rolls (session_id)")
+        cursor.execute("CREATE INDEX ON import_dice_results (roll_id)")
+        for table in ARCHIVE_TABLES:
+            cursor.execute(f"ANALYZE import_{table}")
+
+        # Игроки: существующие находятся по имени, недостающие создаются
+        cursor.execute("""
+            INSERT INTO users (user_name)
+            SELECT DISTINCT user_name FROM import_users
+            ON CONFLICT (user_name) DO NOTHING
+        """)
+        new_users = cursor.rowcount
+        cursor.execute("""
+            CREATE TEMP TABLE import_user_map ON COMMIT DROP AS
+            SELECT i.id AS old_id, u.id AS new_id
+            FROM import_users i
+            JOIN users u ON u.user_name = i.user_name
+        """)
+
+        # Исторические броски без roll_uid получают детерминированный — и в выгрузке, и в базе, куда она
+        # загружается: выгрузка, возвращённая в ту же базу, совпадёт с её бросками и ничего не задвоит
+        for prefix in ("", "import_"):
+            cursor.execute(HISTORICAL_ROLL_UID.format(prefix=prefix))
+        # Сессия, все броски которой уже есть в базе, не создаётся заново; сессии без бросков переносятся
+        cursor.execute("""
+            CREATE TEMP TABLE import_sessions_with_rolls ON COMMIT DROP AS
+            SELECT DISTINCT session_id AS id FROM import_rolls WHERE session_id IS NOT NULL
+        """)
+        cursor.execute("""
+            DELETE FROM import_rolls r
+            USING import_rolls earlier
+            WHERE r.roll_uid = earlier.roll_uid AND r.id > earlier.id
+        """)
+        skipped = cursor.rowcount
+        cursor.execute("DELETE FROM import_rolls r USING rolls e WHERE e.roll_uid = r.roll_uid")
+        skipped += cursor.rowcount
+        cursor.execute("""
+            DELETE FROM import_sessions s
+            WHERE s.id IN (SELECT id FROM import_sessions_with_rolls)
+              AND NOT EXISTS (SELECT 1 FROM import_rolls r WHERE r.session_id = s.id)
+        """)
+
+        # Сессия с тем же началом и столом уже есть в базе (загружена раньше): её броски идут в неё,
+        # иначе повторная загрузка задвоила бы сессии, в которых нет новых бросков
+        cursor.execute("""
+            CREATE TEMP TABLE import_session_map ON COMMIT DROP AS
+            SELECT DISTINCT ON (s.id) s.id AS old_id, e.id AS new_id, false AS created
+            FROM import_sessions s
+            JOIN sessions e ON e.session_start = s.session_start AND e.table_id IS NOT DISTINCT FROM s.table_id
+            ORDER BY s.id, e.id
+        """)
+        # Новые id берутся из последовательностей заранее, в порядке исходных id: порядок сессий сохраняется
+        cursor.execute("""
+            INSERT INTO import_session_map (old_id, new_id, created)
+            SELECT id, nextval(pg_get_serial_sequence('sessions', 'id')), true
+            FROM (
+                SELECT id FROM import_sessions s
+                WHERE NOT EXISTS (SELECT 1 FROM import_session_map m WHERE m.old_id = s.id)
+                ORDER BY id
+            ) ordered
+        """)
+        cursor.execute("""
+            CREATE TEMP TABLE import_roll_map ON COMMIT DROP AS
+            SELECT id AS old_id, nextval(pg_get_serial_sequence('rolls', 'id')) AS new_id
+            FROM (SELECT id FROM import_rolls ORDER BY id) ordered
+        """)
+        for map_table in ("import_session_map", "import_roll_map"):
+            cursor.execute(f"CREATE INDEX ON {map_table} (old_id)")
+            cursor.execute(f"ANALYZE {map_table}")
+        cursor.execute("""
+            INSERT INTO sessions (id, session_start, session_end, table_id)
+            SELECT m.new_id, s.session_start, s.session_end, s.table_id
+            FROM import_sessions s
+            JOIN import_session_map m ON m.old_id = s.id AND m.created
+        """)
+        sessions = cursor.rowcount
+        # Бросок с тем же roll_uid мог прийти от живого стола, пока шла загрузка: его кости не копируются
+        cursor.execute("""
+            WITH inserted AS (
+                INSERT INTO rolls (id, user_id, session_id, total_result, roll_timestamp, roll_uid)
+                SELECT m.new_id, um.new_id, sm.new_id, r.total_result, r.roll_timestamp, r.roll_uid
+                FROM import_rolls r
+                JOIN import_roll_map m ON m.old_id = r.id
+                LEFT JOIN import_user_map um ON um.old_id = r.user_id
+                LEFT JOIN import_session_map sm ON sm.old_id = r.session_id
+                ON CONFLICT (roll_uid) DO NOTHING
+                RETURNING id
+            )
+            INSERT INTO dice_results (roll_id, dice_result)
+            SELECT m.new_id, d.dice_result
+            FROM import_dice_results d
+            JOIN import_roll_map m ON m.old_id = d.roll_id
+            JOIN inserted i ON i.id = m.new_id
+            ORDER BY d.id
+        """)
+        dice = cursor.rowcount
+        cursor.execute("SELECT COUNT(*) FROM rolls WHERE id IN (SELECT new_id FROM import_roll_map)")
+        rolls = cursor.fetchone()[0]
+        # Броски могли добавиться к уже существующей сессии, поэтому агрегаты прибавляются, а не создаются
+        cursor.execute(ROLLUP_UPSERT.format(rows="""
+            SELECT session_id, user_id, COUNT(*), SUM(total_result),
+                   COUNT(*) FILTER (WHERE total_result BETWEEN %s AND %s),
+                   COUNT(*) FILTER (WHERE total_result BETWEEN %s AND %s)
+            FROM rolls
+            WHERE id IN (SELECT new_id FROM import_roll_map)
+              AND session_id IS NOT NULL AND user_id IS NOT NULL
+            GROUP BY session_id, user_id
+            ORDER BY session_id, user_id
+        """), CRITICAL_SUCCESS + CRITICAL_FAILURE)
+        return {"sessions": sessions, "users": new_users, "rolls": rolls, "dice_results": dice, "skipped": skipped}
@@ -11,7 +11,57 @@ from discord import app_commands
 from dotenv import load_dotenv
 import os
 import asyncio
-from layers.visualization_layer import VisualizationLayer
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from layers.metrics_layer import metrics
+from layers.visualization_layer import ChartRenderBusy
+
+
+class ChartCommandExecutor:
+    """
+    Ограниченный executor для графиков команд бота с объединением одинаковых запросов (single-flight).
+    Пока задача с тем же ключом (метод и аргументы) выполняется, новые команды ждут её результат, а не
+    запускают свой запрос и рендер. Различных задач в работе и в очереди не больше queue_size — следующая
+    получает ChartRenderBusy, и бот сразу отвечает, что занят. Вызывается только из цикла событий бота.
+    """
+
+    def __init__(self, workers=None, queue_size=None):
+        self.workers = workers or int(os.getenv("BOT_CHART_WORKERS", "4"))
+        self.queue_size = queue_size or int(os.getenv("BOT_CHART_QUEUE", "16"))
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="chart-command")
+        # ключ -> asyncio.Future выполняющейся задачи
+        self._inflight = {}
+        metrics.gauge_callback("bot_chart_queue_depth", lambda: len(self._inflight))
+
+    async def run(self, key, func, *args):
+        command = key[0]
+        future = self._inflight.get(key)
+        if future is not None:
+            metrics.inc("bot_chart_coalesced_total", command=command)
+        else:
+            if len(self._inflight) >= self.queue_size:
+                metrics.inc("bot_chart_rejected_total", command=command)
+                raise ChartRenderBusy(f"Chart command queue is full ({self.queue_size} jobs)")
+            submitted = time.perf_counter()
+
+            def job():
+                metrics.observe("bot_chart_wait_seconds", time.perf_counter() - submitted, command=command)
+                return func(*args)
+
+            future = asyncio.get_event_loop().run_in_executor(self.executor, job)
+            self._inflight[key] = future
+            future.add_done_callback(lambda done: self._finish(key, done))
+        # shield: команда, отменённая посреди ожидания, не отменяет общую задачу остальных
+        return await asyncio.shield(future)
+
+    def _finish(self, key, future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        if not future.cancelled():
+            # Ошибку получили ожидавшие команды; если их не осталось, asyncio не должен жаловаться на неё в лог
+            future.exception()
 
 class BotLayer:
     def __init__(self, db_layer):
@@ -25,9 +75,18 @@ class BotLayer:
         if not self.token or not self.name or not self.app_id:
             raise ValueError("Missing required environment variables: TOKEN, NAME, or ID")
 
-        # Сохраняем db_layer для передачи в VisualizationLayer
+        # Сохраняем db_layer для передачи в VisualizationLayer; сам слой графиков (пул рендера, реплика)
+        # создаётся при первом графике, а не при старте сервиса
         self.db_layer = db_layer
-        self.viz_layer = VisualizationLayer(db_layer)
+        self._viz_layer = None
+        self._viz_lock = threading.Lock()
+        # Запросы и рендер графиков команд: ограниченный executor, одинаковые команды объединяются
+        self.chart_executor = ChartCommandExecutor()
+        # Выставляется, когда бот подключился к Discord (для /ready)
+        self.ready = threading.Event()
+        # Живая лента бросков: включается, если задан канал LIVE_FEED_CHANNEL_ID
+        self.live_feed_channel_id = int(os.getenv("LIVE_FEED_CHANNEL_ID", "0")) or None
+        self.live_feed = None
 
         # Настраиваем интенты
         intents = discord.Intents.default()
@@ -44,14 +103,28 @@ class BotLayer:
             # Синхронизируем команды с Discord
             await self.tree.sync()
             print("Slash commands synced!")
+            if self.live_feed is not None:
+                self.live_feed.start()
+            self.ready.set()
 
         # Регистрируем слэш-команду /testcharts
         @self.tree.command(name="testcharts", description="Генерирует все тестовые графики и сохраняет их в папку test_all_charts")
         async def test_charts(interaction: discord.Interaction):
             await interaction.response.send_message("Генерирую тестовые графики...")
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(None, self.viz_layer.save_all_plots)
-            await interaction.followup.send("Все тестовые графики сохранены в папке test_all_charts.")
+            try:
+                elapsed, failures = await self.chart_executor.run(("save_all_plots",),
+                                                                  lambda: self.viz_layer.save_all_plots())
+            except ChartRenderBusy:
+                await interaction.followup.send("Сейчас строится слишком много графиков, попробуйте через минуту.")
+                return
+            if not failures:
+                await interaction.followup.send(f"Все тестовые графики сохранены в папке test_all_charts за {elapsed:.1f} с.")
+                return
+            reasons = {ChartRenderBusy: "очередь рендера занята", TimeoutError: "не успел построиться"}
+            failed = "\n".join(f"- {filename}: {reasons.get(type(error), 'ошибка отрисовки')}"
+                                for filename, error in sorted(failures.items()))
+            await interaction.followup.send(f"Тестовые графики сохранены в папке test_all_charts за {elapsed:.1f} с, "
+                                            f"кроме {len(failures)}:\n{failed}")
 
         # Регистрируем слэш-команду /sessionavg
         @self.tree.command(name="sessionavg", description="Показывает линейный график средних значений бросков по сессиям")
@@ -63,45 +136,37 @@ class BotLayer:
         async def session_avg(interaction: discord.Interaction, by_players: str = "no"):
             by_players_bool = by_players == "yes"
             await interaction.response.send_message("Генерирую график средних значений по сессиям...")
-            loop = asyncio.get_event_loop()
-            filename = await loop.run_in_executor(None, self.viz_layer.plot_average_rolls_by_session, by_players_bool)
-            with open(f'charts/{filename}', "rb") as f:
-                picture = discord.File(f)
-                await interaction.followup.send(file=picture)
+            await self.send_chart(interaction, "average_rolls_by_session.png", "plot_average_rolls_by_session", by_players_bool)
 
         # Регистрируем слэш-команду /playeravg
         @self.tree.command(name="playeravg", description="Показывает столбчатую диаграмму средних значений бросков по игрокам")
-        @app_commands.describe(session="Выберите сессию для отображения (или оставьте пустым для всех сессий)")
+        @app_commands.describe(session="Выберите сессию для отображения (или оставьте пустым для всех сессий)",
+                               table="Стол Tabletop Simulator: «последняя сессия» ищется среди его сессий")
         @app_commands.choices(session=[
             app_commands.Choice(name="Все сессии", value="all"),
             app_commands.Choice(name="Последняя сессия", value="last")
         ])
-        async def player_avg(interaction: discord.Interaction, session: str = "all", session_num: int = None):
-            last_session = session == "last"
-            session_num_value = session_num if session_num is not None else None
+        async def player_avg(interaction: discord.Interaction, session: str = "all", session_num: int = None,
+                             table: str = None):
             await interaction.response.send_message("Генерирую график средних значений по игрокам...")
-            loop = asyncio.get_event_loop()
-            filename = await loop.run_in_executor(None, self.viz_layer.plot_average_rolls_by_player, last_session, session_num_value)
-            with open(f'charts/{filename}', "rb") as f:
-                picture = discord.File(f)
-                await interaction.followup.send(file=picture)
+            resolved = await self.resolve_session(interaction, session == "last", session_num, table)
+            if resolved is not None:
+                await self.send_chart(interaction, "average_rolls_by_player.png", "plot_average_rolls_by_player", *resolved)
 
         # Регистрируем слэш-команду /critical
         @self.tree.command(name="critical", description="Показывает столбчатую диаграмму критических бросков по игрокам")
-        @app_commands.describe(session="Выберите сессию для отображения (или оставьте пустым для всех сессий)")
+        @app_commands.describe(session="Выберите сессию для отображения (или оставьте пустым для всех сессий)",
+                               table="Стол Tabletop Simulator: «последняя сессия» ищется среди его сессий")
         @app_commands.choices(session=[
             app_commands.Choice(name="Все сессии", value="all"),
             app_commands.Choice(name="Последняя сессия", value="last")
         ])
-        async def critical_rolls(interaction: discord.Interaction, session: str = "all", session_num: int = None):
-            last_session = session == "last"
-            session_num_value = session_num if session_num is not None else None
+        async def critical_rolls(interaction: discord.Interaction, session: str = "all", session_num: int = None,
+                                 table: str = None):
             await interaction.response.send_message("Генерирую график критических бросков...")
-            loop = asyncio.get_event_loop()
-            filename = await loop.run_in_executor(None, self.viz_layer.plot_critical_rolls_by_player, last_session, session_num_value)
-            with open(f'charts/{filename}', "rb") as f:
-                picture = discord.File(f)
-                await interaction.followup.send(file=picture)
+            resolved = await self.resolve_session(interaction, session == "last", session_num, table)
+            if resolved is not None:
+                await self.send_chart(interaction, "critical_rolls_by_player.png", "plot_critical_rolls_by_player", *resolved)
 
         # Регистрируем слеш-команду /sessionduration
         @self.tree.command(name="sessionduration",
@@ -109,11 +174,26 @@ class BotLayer:
         @discord.app_commands.describe(by_week="Показать данные по неделям? (true/false)")
         async def session_duration(interaction: discord.Interaction, by_week: bool = False):
             await interaction.response.send_message("Генерирую график длительности сессий...")
-            loop = asyncio.get_event_loop()
-            filename = await loop.run_in_executor(None, self.viz_layer.plot_session_durations, by_week)
-            with open(filename, "rb") as f:
-                picture = discord.File(f)
-                await interaction.followup.send(file=picture)
+            await self.send_chart(interaction, "session_durations.png", "plot_session_durations", by_week)
+
+        # Регистрируем слэш-команду /fairness
+        @self.tree.command(name="fairness", description="Проверяет честность костей: частоты граней и критерий хи-квадрат")
+        @app_commands.describe(group="Сравнивать игроков или сессии",
+                               session="Выберите сессию для отображения (или оставьте пустым для всех сессий)",
+                               table="Стол Tabletop Simulator: «последняя сессия» ищется среди его сессий")
+        @app_commands.choices(group=[
+            app_commands.Choice(name="По игрокам", value="players"),
+            app_commands.Choice(name="По сессиям", value="sessions")
+        ], session=[
+            app_commands.Choice(name="Все сессии", value="all"),
+            app_commands.Choice(name="Последняя сессия", value="last")
+        ])
+        async def dice_fairness(interaction: discord.Interaction, group: str = "players", session: str = "all",
+                                session_num: int = None, table: str = None):
+            await interaction.response.send_message("Проверяю честность костей...")
+            resolved = await self.resolve_session(interaction, session == "last", session_num, table)
+            if resolved is not None:
+                await self.send_chart(interaction, "dice_fairness.png", "plot_dice_fairness", group == "sessions", *resolved)
 
         # Регистрируем слэш-команду /help
         @self.tree.command(name="help", description="Показывает список доступных команд и их параметры")
@@ -136,9 +216,11 @@ class BotLayer:
   - Параметры:
     - session: Выберите "Последняя сессия" или "Все сессии" (по умолчанию "Все сессии").
     - session_num: Укажите номер сессии (необязательно).
+    - table: Стол, чья последняя сессия нужна (необязательно; без него — последняя сессия всех столов).
   - Примеры:
     - /playeravg
     - /playeravg session:Последняя сессия
+    - /playeravg session:Последняя сессия table:kitchen
     - /playeravg session_num:1
 
 /critical
@@ -146,17 +228,88 @@ class BotLayer:
   - Параметры:
     - session: Выберите "Последняя сессия" или "Все сессии" (по умолчанию "Все сессии").
     - session_num: Укажите номер сессии (необязательно).
+    - table: Стол, чья последняя сессия нужна (необязательно).
   - Примеры:
     - /critical
     - /critical session:Последняя сессия
     - /critical session_num:1
 
+/fairness
+  - Показывает доли граней костей по игрокам или сессиям и критерий хи-квадрат (p < 0.05 — повод присмотреться к кости).
+  - Параметры:
+    - group: "По игрокам" или "По сессиям" (по умолчанию "По игрокам").
+    - session: Выберите "Последняя сессия" или "Все сессии" (по умолчанию "Все сессии").
+    - session_num: Укажите номер сессии (необязательно).
+    - table: Стол, чья последняя сессия нужна (необязательно).
+  - Примеры:
+    - /fairness
+    - /fairness group:По сессиям
+    - /fairness session:Последняя сессия
+
 /help
   - Показывает это сообщение со списком команд и их параметров.
   - Пример: /help
             """
             await interaction.response.send_message(help_text)
 
+    def start_live_feed(self, broker_layer):
+        """
+        Подписывает живую ленту на события бросков брокера. Цикл публикации стартует в on_ready,
+        а если бот уже подключён — сразу в его цикле событий.
+        """
+        if self.live_feed_channel_id is None:
+            return None
+        from layers.live_feed_layer import LiveRollFeed
+        self.live_feed = LiveRollFeed(self.bot, self.live_feed_channel_id)
+        broker_layer.subscribe_roll_events(self.live_feed.add_event)
+        if self.ready.is_set():
+            self.bot.loop.call_soon_threadsafe(self.live_feed.start)
+        return self.live_feed
+
+    @property
+    def viz_layer(self):
+        with self._viz_lock:
+            if self._viz_layer is None:
+                from layers.visualization_layer import VisualizationLayer
+                self._viz_layer = VisualizationLayer(self.db_layer)
+            return self._viz_layer
+
+    async def resolve_session(self, interaction, last_session, session_num, table):
+        """
+        «Последняя сессия» указанного стола превращается в номер его последней сессии; без стола
+        остаётся последней сессией вообще. Возвращает (last_session, session_num) или None,
+        если у стола ещё нет сессий или очередь занята (тогда пользователю уже отправлен ответ).
+        """
+        if not table or not last_session:
+            return last_session, session_num
+        # Запрос к базе идёт через тот же ограниченный executor, что и графики, а не в общий пул цикла событий
+        try:
+            session_id = await self.chart_executor.run(("last_session_id", table), self.db_layer.last_session_id, table)
+        except ChartRenderBusy:
+            await interaction.followup.send("Сейчас строится слишком много графиков, попробуйте через минуту.")
+            return None
+        if session_id is None:
+            await interaction.followup.send(f"У стола {table} ещё нет сессий.")
+            return None
+        return False, session_id
+
+    async def send_chart(self, interaction, filename, plot, *args):
+        """
+        Рисует график plot (имя метода VisualizationLayer) в chart_executor и отправляет PNG из памяти;
+        одинаковые команды, пришедшие одновременно, получают одну картинку. При перегрузке или таймауте
+        рендера отвечает текстом. Слой графиков создаётся тоже в executor, чтобы первый график
+        не блокировал цикл событий бота.
+        """
+        try:
+            png = await self.chart_executor.run((plot,) + args, lambda: getattr(self.viz_layer, plot)(*args))
+        except ChartRenderBusy:
+            await interaction.followup.send("Сейчас строится слишком много графиков, попробуйте через минуту.")
+            return
+        except TimeoutError:
+            await interaction.followup.send("График не успел построиться, попробуйте ещё раз.")
+            return
+        await interaction.followup.send(file=discord.File(io.BytesIO(png), filename=filename))
+
     def run(self):
         """Запускает бота с использованием токена."""
         self.bot.run(self.token)
\ No newline at end of file
@@ -0,0 +1,138 @@
+"""
+Данный модуль — живая лента бросков в Discord. События бросков приходят из fanout-обменника брокера
+(MsgBrokerLayer.subscribe_roll_events) в поток подписчика и только обновляют сводку сессии в памяти.
+Раз в LIVE_FEED_INTERVAL секунд цикл бота публикует изменившиеся сводки: одно сообщение на сессию стола,
+которое затем редактируется. Сколько бы бросков ни пришло за интервал, в Discord уходит не больше одного
+запроса на сессию, а отправки не копятся — каждая публикует уже актуальное состояние.
+"""
+
+import asyncio
+import os
+import threading
+from datetime import datetime
+
+import discord
+
+from layers.db_layer import CRITICAL_FAILURE, CRITICAL_SUCCESS
+
+# Предел длины сообщения Discord
+MESSAGE_LIMIT = 2000
+
+
+class SessionSummary:
+    """Накопленная статистика одной сессии стола."""
+
+    def __init__(self, table_id, session_id):
+        self.table_id = table_id
+        self.session_id = session_id
+        # игрок -> [бросков, сумма, крит. удач, крит. неудач, последний бросок]
+        self.players = {}
+        self.roll_uids = set()
+        self.rolls = 0
+
+    def add(self, event):
+        roll_uid = event.get("roll_uid")
+        if roll_uid is not None:
+            # Повторно доставленный бросок не считаем дважды
+            if roll_uid in self.roll_uids:
+                return False
+            self.roll_uids.add(roll_uid)
+        total = event["total"]
+        stats = self.players.setdefault(event["player"], [0, 0, 0, 0, None])
+        stats[0] += 1
+        stats[1] += total
+        stats[2] += CRITICAL_SUCCESS[0] <= total <= CRITICAL_SUCCESS[1]
+        stats[3] += CRITICAL_FAILURE[0] <= total <= CRITICAL_FAILURE[1]
+        stats[4] = event["results"]
+        self.rolls += 1
+        return True
+
+    def render(self):
+        lines = [
+            f"🎲 Стол **{self.table_id}** · сессия {self.session_id}",
+            f"Бросков: {self.rolls} · обновлено {datetime.now():%H:%M:%S}",
+        ]
+        for player, (count, total, success, failure, last) in sorted(
+                self.players.items(), key=lambda item: -item[1][0]):
+            line = (f"**{player}** — {count} бр., среднее {total / count:.1f}, "
+                    f"крит. удачи {success}, неудачи {failure}, последний: "
+                    f"{'+'.join(str(result) for result in last)} = {sum(last)}")
+            if sum(len(text) + 1 for text in lines) + len(line) > MESSAGE_LIMIT - 20:
+                lines.append(f"… и ещё {len(self.players) - len(lines) + 2} игроков")
+                break
+            lines.append(line)
+        return "\n".join(lines)
+
+
+class LiveRollFeed:
+    def __init__(self, client, channel_id, interval=None):
+        self.client = client
+        self.channel_id = channel_id
+        self.interval = interval or float(os.getenv("LIVE_FEED_INTERVAL", "5"))
+        # стол -> сводка его текущей сессии
+        self._summaries = {}
+        self._dirty = set()
+        # (стол, сессия) -> опубликованное сообщение
+        self._messages = {}
+        # События приходят из потока подписчика, публикация идёт в цикле событий бота
+        self._lock = threading.Lock()
+        self._task = None
+
+    def add_event(self, event):
+        """Учитывает событие броска. Вызывается из потока подписчика брокера."""
+        table_id = event.get("table", "default")
+        session_id = event["session_id"]
+        with self._lock:
+            summary = self._summaries.get(table_id)
+            if summary is None or session_id > summary.session_id:
+                # Новая сессия стола начинает новое сообщение, сводка прошлой остаётся как есть
+                summary = self._summaries[table_id] = SessionSummary(table_id, session_id)
+            elif session_id < summary.session_id:
+                return
+            if summary.add(event):
+                self._dirty.add(table_id)
+
+    def start(self):
+        """Запускает цикл публикации в текущем цикле событий; повторный вызов ничего не делает."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_event_loop().create_task(self.run())
+
+    async def run(self):
+        delay = self.interval
+        print(f"LiveRollFeed: Posting roll summaries to channel {self.channel_id} every {self.interval:.0f}s")
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.flush()
+                delay = self.interval
+            except discord.HTTPException as e:
+                # Discord всё-таки ответил отказом (в том числе 429): реже публикуем, пока не пройдёт
+                delay = min(delay * 2, 60)
+                print(f"LiveRollFeed: Discord rejected update ({e.status}), next attempt in {delay:.0f}s")
+            except Exception as e:
+                # Обрыв сети, удалённый канал, нет прав: задача ленты не должна умирать молча
+                delay = min(delay * 2, 60)
+                print(f"LiveRollFeed: Error posting update: {e!r}, next attempt in {delay:.0f}s")
+
+    async def flush(self):
+        """Публикует изменившиеся сводки: новое сообщение для новой сессии, правка — для текущей."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            updates = [(summary.table_id, summary.session_id, summary.render())
+                       for summary in (self._summaries[table_id] for table_id in dirty)]
+        for index, (table_id, session_id, text) in enumerate(updates):
+            try:
+                message = self._messages.get((table_id, session_id))
+                if message is not None:
+                    await message.edit(content=text)
+                else:
+                    channel = self.client.get_channel(self.channel_id) or await self.client.fetch_channel(self.channel_id)
+                    # Сообщения прошлых сессий стола больше не редактируются
+                    for key in [key for key in self._messages if key[0] == table_id]:
+                        del self._messages[key]
+                    self._messages[(table_id, session_id)] = await channel.send(text)
+            except Exception:
+                # Неопубликованные сводки вернутся в следующий интервал с уже свежими данными
+                with self._lock:
+                    self._dirty.update(table for table, _, _ in updates[index:])
+                raise
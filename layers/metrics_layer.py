@@ -0,0 +1,181 @@
+"""
+Данный модуль собирает лёгкие метрики всех слоёв: счётчики и гистограммы длительностей операций
+(декодирование запроса, запросы к базе по имени, публикация и потребление сообщений, отрисовка графиков).
+Метрики отдаются в текстовом формате Prometheus на маршруте /metrics слоя APILayer.
+Здесь же находится выборочное логирование содержимого запросов, которое включается через .env
+"""
+
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+from dotenv import load_dotenv
+
+# Границы корзин гистограмм в секундах: от долей миллисекунды до секунд рендера графиков
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._gauge_callbacks = {}
+        self._help = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def set_gauge(self, name, value, **labels):
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def gauge_callback(self, name, callback, **labels):
+        """Значение gauge вычисляется при каждом чтении /metrics (например, глубина очереди)."""
+        with self._lock:
+            self._gauge_callbacks[self._key(name, labels)] = callback
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def timed(self, name, **labels):
+        """Декоратор: длительность каждого вызова попадает в гистограмму name."""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - started, **labels)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+    def render_prometheus(self):
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            callbacks = dict(self._gauge_callbacks)
+            histograms = {key: (list(h.counts), h.total, h.count, h.buckets) for key, h in self._histograms.items()}
+
+        for key, callback in callbacks.items():
+            try:
+                gauges[key] = callback()
+            except Exception:
+                continue
+
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name in described:
+                return
+            described.add(name)
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), value in sorted(gauges.items()):
+            header(name, "gauge")
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), (counts, total, count, buckets) in sorted(histograms.items()):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{self._format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {total}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+metrics.describe("api_request_duration_seconds", "HTTP request latency by route")
+metrics.describe("api_stage_duration_seconds", "Latency of API hot-path stages")
+metrics.describe("db_query_duration_seconds", "DBLayer call latency by query name")
+metrics.describe("broker_publish_latency_seconds", "Enqueue-to-confirm latency of published messages")
+metrics.describe("broker_consume_batch_duration_seconds", "Time to persist and ack one consumed batch")
+metrics.describe("db_stream_rows_total", "Rows read through server-side streaming cursors")
+metrics.describe("startup_step_duration_seconds", "Duration of each service startup step")
+metrics.describe("chart_render_duration_seconds", "Chart query and render time by chart")
+metrics.describe("chart_batch_duration_seconds", "Wall time of rendering all /testcharts variants")
+metrics.describe("db_duplicate_rolls_total", "Redelivered rolls skipped by roll_uid, by the in-memory filter or the unique index")
+metrics.describe("broker_roll_events_dropped_total", "Roll events for live subscribers dropped on a full publish queue")
+metrics.describe("spool_appends_total", "Rolls appended to the local spool")
+metrics.describe("spool_fallback_total", "Rolls spooled because the database or broker was unavailable")
+metrics.describe("spool_replayed_total", "Spooled rolls written to the database by the replayer")
+metrics.describe("spool_replay_failures_total", "Failed spool replay attempts")
+metrics.describe("spool_rejected_total", "Spooled rolls rejected by the database and moved to rejected.jsonl")
+metrics.describe("broker_rejected_total", "Consumed messages the database rejected on their own, moved to rejected.jsonl")
+metrics.describe("spool_backlog_bytes", "Bytes in the spool not yet replayed into the database")
+metrics.describe("api_not_modified_total", "Read API requests answered 304 Not Modified by ETag")
+metrics.describe("bot_chart_queue_depth", "Distinct bot chart commands running or waiting in the chart executor")
+metrics.describe("bot_chart_wait_seconds", "Time a bot chart command waited for a chart executor thread")
+metrics.describe("bot_chart_coalesced_total", "Bot chart commands that joined an identical in-flight command")
+metrics.describe("bot_chart_rejected_total", "Bot chart commands rejected with a busy reply on a full chart executor")
+metrics.describe("chart_render_queue_depth", "Chart render jobs running or waiting in the render pool")
+
+load_dotenv()
+# Подробное логирование содержимого запросов и сообщений: выключено по умолчанию, при включении — выборочное
+LOG_PAYLOADS = os.getenv("LOG_PAYLOADS", "0") == "1"
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.01"))
+
+
+def log_payload(message, payload):
+    """
+    Печатает сообщение с содержимым запроса, только если логирование включено и запрос попал в выборку.
+    Строка собирается внутри, поэтому при выключенном логировании payload не форматируется.
+    """
+    if LOG_PAYLOADS and random.random() < LOG_PAYLOAD_SAMPLE_RATE:
+        print(f"{message}{payload}")
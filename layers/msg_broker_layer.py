@@ -2,8 +2,27 @@
 
 import pika
 import json
+import os
+import queue
 import threading
-from layers.db_layer import DBLayer
+import time
+from collections import deque
+from datetime import datetime
+from concurrent.futures import Future
+from dotenv import load_dotenv
+from layers.db_layer import CONNECTION_ERRORS, DBLayer
+from layers.metrics_layer import log_payload, metrics
+
+def should_requeue(redelivered, error):
+    """
+    Вернуть ли упавшее сообщение в очередь. Запись броска идемпотентна (roll_uid), поэтому повтор безопасен,
+    но сообщение, которое уже доставлялось и снова упало не из-за соединения, бесконечно не возвращается.
+    """
+    return not redelivered or isinstance(error, CONNECTION_ERRORS)
+
+
+# Fanout-обменник событий принятых бросков: каждый подписчик (например, живая лента бота) получает свою копию
+ROLL_EVENTS_EXCHANGE = "roll_events"
 
 class MsgBrokerLayer:
     def __init__(self, db_layer):
@@ -14,43 +33,101 @@ class MsgBrokerLayer:
         # Словарь обработчиков: (функция, ожидает_ли_данные)
         self.command_handlers = {
             "roll": (self.db_layer.record_roll, True),  # Требует данные
-            "end_session": (self.db_layer.end_session, False)  # Не требует данные
+            "end_session": (self.end_session, True)  # Данные: id сессии стола
         }
+        # Команды, которые консьюмер копит и передаёт обработчику пачкой
+        self.batch_handlers = {
+            "roll": self.db_layer.record_rolls_batch
+        }
+        load_dotenv()
+        self.consumer_count = int(os.getenv("BROKER_CONSUMERS", "2"))
+        self.batch_size = int(os.getenv("BROKER_BATCH_SIZE", "100"))
+        self.flush_interval = float(os.getenv("BROKER_FLUSH_INTERVAL", "0.5"))
+        self.consumers = []
+        # Броски, которые база отвергла и поштучно, откладываются в тот же файл, что и отклонённые спулом
+        self.rejected_path = os.path.join(os.getenv("SPOOL_DIR", "spool"), "rejected.jsonl")
+        # Сколько секунд process_request ждёт подтверждения публикации брокером
+        self.publish_timeout = float(os.getenv("BROKER_PUBLISH_TIMEOUT", "5"))
+        self.publisher = ConfirmedPublisher(self)
         self.connect()
 
-    def connect(self):
-        # Подключаемся к RabbitMQ
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters('localhost'))
-        self.channel = self.connection.channel()
+    @staticmethod
+    def connection_parameters():
+        return pika.ConnectionParameters('localhost')
+
+    def open_channel(self):
+        # Отдельное соединение: BlockingConnection нельзя делить между потоками
+        connection = pika.BlockingConnection(self.connection_parameters())
+        channel = connection.channel()
         # Создаём очереди для каждой команды
         for command in self.command_handlers.keys():
-            self.channel.queue_declare(queue=f"{command}_queue", durable=True)
+            channel.queue_declare(queue=f"{command}_queue", durable=True)
+        channel.exchange_declare(exchange=ROLL_EVENTS_EXCHANGE, exchange_type="fanout", durable=True)
+        return connection, channel
+
+    def connect(self):
+        # Подключаемся к RabbitMQ и объявляем очереди. Соединение для публикации держит поток publisher'а,
+        # а простаивающее соединение без обслуживания heartbeat'ов брокер со временем закроет
+        connection, _ = self.open_channel()
+        connection.close()
+        self.publisher.start()
         print("MsgBrokerLayer: Connected to RabbitMQ and queues declared")
 
-    def process_request(self, command, data):
-        # Отправляем данные в очередь (Producer)
+    def process_request(self, command, data, wait=True):
+        # Отправляем данные в очередь (Producer) через поток публикации, сам канал из других потоков не трогаем
         if command not in self.command_handlers:
             raise ValueError(f"Unknown command: {command}")
         try:
             queue_name = f"{command}_queue"
-            self.channel.basic_publish(
-                exchange='',
-                routing_key=queue_name,
-                body=json.dumps(data).encode(),
-                properties=pika.BasicProperties(delivery_mode=2)
-            )
-            print(f"MsgBrokerLayer: Sent to {queue_name}: {data}")
+            future = self.publisher.publish(queue_name, json.dumps(data).encode())
+            if wait:
+                # Ждём, пока брокер подтвердит пачку, в которую попало сообщение
+                future.result(timeout=self.publish_timeout)
+            log_payload(f"MsgBrokerLayer: Sent to {queue_name}: ", data)
+            return future
         except Exception as e:
             print(f"MsgBrokerLayer: Error sending to queue {command}: {e}")
             raise
 
+    def publish_roll_events(self, events):
+        """
+        Публикует события бросков в ROLL_EVENTS_EXCHANGE. Подтверждения не ждёт: события нужны только
+        живым подписчикам, и приём бросков не должен от них зависеть.
+        """
+        for event in events:
+            try:
+                self.publisher.publish("", json.dumps(event).encode(), exchange=ROLL_EVENTS_EXCHANGE)
+            except RuntimeError:
+                # Очередь публикации переполнена: событие ленты теряем, бросок уже принят
+                metrics.inc("broker_roll_events_dropped_total")
+
+    def subscribe_roll_events(self, on_event, queue_name="roll_events.live_feed"):
+        """Запускает поток, вызывающий on_event(событие) для каждого события броска."""
+        subscriber = RollEventSubscriber(self, on_event, queue_name)
+        subscriber.start()
+        return subscriber
+
+    def reject_message(self, command, data, error):
+        """Откладывает сообщение, которое обработчик отвергает и само по себе, чтобы оно не блокировало очередь."""
+        print(f"MsgBrokerLayer: {command} rejected, moved to {self.rejected_path}: {error}")
+        metrics.inc("broker_rejected_total", command=command)
+        os.makedirs(os.path.dirname(self.rejected_path) or ".", exist_ok=True)
+        with open(self.rejected_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(data) + "\n")
+
+    def end_session(self, data):
+        # Сообщения, опубликованные до появления столов, не содержат session_id и завершают последнюю сессию,
+        # а до появления session_end — завершают её временем записи
+        session_end = data.get("session_end")
+        self.db_layer.end_session(data.get("session_id"), datetime.fromisoformat(session_end) if session_end else None)
+
     def callback(self, command):
         # Универсальный обработчик для всех команд
         def _callback(ch, method, properties, body):
             try:
                 # Декодируем сообщение
                 data = json.loads(body.decode())
-                print(f"MsgBrokerLayer: Received from {command}_queue: {data}")
+                log_payload(f"MsgBrokerLayer: Received from {command}_queue: ", data)
                 # Получаем обработчик и флаг ожидания данных
                 handler, expects_data = self.command_handlers[command]
                 # Если команда ожидает данные, передаём их, иначе вызываем без аргументов
@@ -58,36 +135,480 @@ class MsgBrokerLayer:
                     handler(data)
                 else:
                     handler()
-                print(f"MsgBrokerLayer: Processed {command} for data: {data}")
+                metrics.inc("broker_consumed_messages_total", command=command)
                 ch.basic_ack(delivery_tag=method.delivery_tag)
             except Exception as e:
                 print(f"MsgBrokerLayer: Error processing {command}: {e}")
-                ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+                ch.basic_nack(delivery_tag=method.delivery_tag, requeue=should_requeue(method.redelivered, e))
         return _callback
 
-    def start_consuming(self):
-        # Настройка Consumer’ов
-        self.channel.basic_qos(prefetch_count=1)
-        for command in self.command_handlers.keys():
-            queue_name = f"{command}_queue"
-            self.channel.basic_consume(queue=queue_name, on_message_callback=self.callback(command))
-            print(f"MsgBrokerLayer: Started consuming from '{queue_name}'")
-        try:
-            self.channel.start_consuming()
-        except KeyboardInterrupt:
-            self.stop_consuming()
+    def start_consuming(self, batch_size=None, flush_interval=None):
+        # Один консьюмер пула со своим соединением; блокирует поток до остановки и переподключается при обрыве
+        consumer = BatchConsumer(self, batch_size or self.batch_size, flush_interval or self.flush_interval)
+        self.consumers.append(consumer)
+        reconnect_delay = 0.5
+        while consumer.running:
+            try:
+                consumer.run()
+            except KeyboardInterrupt:
+                consumer.stop()
+            except pika.exceptions.AMQPError as e:
+                if not consumer.running:
+                    break
+                if consumer.consuming:
+                    reconnect_delay = 0.5
+                print(f"MsgBrokerLayer: Consumer connection lost, reconnecting in {reconnect_delay:.1f}s: {e}")
+                self.publisher.metrics.record_reconnect()
+                time.sleep(reconnect_delay)
+                reconnect_delay = min(reconnect_delay * 2, self.publisher.max_reconnect_delay)
 
     def stop_consuming(self):
+        # Консьюмеры сами закрывают свои соединения, выйдя из цикла
+        for consumer in self.consumers:
+            consumer.stop()
+        self.publisher.stop()
         # Закрытие соединения
-        if self.channel:
+        if self.channel and self.channel.is_open:
             self.channel.close()
-        if self.connection:
+        if self.connection and self.connection.is_open:
             self.connection.close()
         print("MsgBrokerLayer: Stopped consuming")
 
+    def run(self, consumers=None):
+        # Запуск пула Consumer’ов, каждый в своём потоке
+        consumers = consumers or self.consumer_count
+        for index in range(consumers):
+            consumer_thread = threading.Thread(target=self.start_consuming, name=f"broker-consumer-{index}")
+            consumer_thread.daemon = True
+            consumer_thread.start()
+        print(f"MsgBrokerLayer: {consumers} consumer threads started")
+
+
+class RollEventSubscriber:
+    """
+    Подписчик ROLL_EVENTS_EXCHANGE в своём потоке и со своим соединением. Очередь именованная, поэтому
+    события, пришедшие во время переподключения, не теряются; x-max-length не даёт ей расти без предела,
+    пока подписчик не работает.
+    """
+
+    def __init__(self, broker_layer, on_event, queue_name):
+        self.broker_layer = broker_layer
+        self.on_event = on_event
+        self.queue_name = queue_name
+        self.max_length = int(os.getenv("ROLL_EVENTS_QUEUE_MAX", "10000"))
+        self.running = False
+        self._thread = None
+
+    def start(self):
+        self.running = True
+        self._thread = threading.Thread(target=self._run, name="roll-events", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def _on_message(self, ch, method, properties, body):
+        try:
+            self.on_event(json.loads(body.decode()))
+        except Exception as e:
+            print(f"MsgBrokerLayer: Error handling roll event: {e}")
+
+    def _run(self):
+        reconnect_delay = 0.5
+        while self.running:
+            connection = None
+            try:
+                connection, channel = self.broker_layer.open_channel()
+                channel.queue_declare(queue=self.queue_name, arguments={"x-max-length": self.max_length})
+                channel.queue_bind(exchange=ROLL_EVENTS_EXCHANGE, queue=self.queue_name)
+                channel.basic_consume(queue=self.queue_name, on_message_callback=self._on_message, auto_ack=True)
+                print(f"MsgBrokerLayer: Subscribed to roll events via '{self.queue_name}'")
+                reconnect_delay = 0.5
+                while self.running:
+                    connection.process_data_events(time_limit=1)
+            except pika.exceptions.AMQPError as e:
+                print(f"MsgBrokerLayer: Roll event subscription lost, reconnecting in {reconnect_delay:.1f}s: {e}")
+                time.sleep(reconnect_delay)
+                reconnect_delay = min(reconnect_delay * 2, 30)
+            finally:
+                if connection is not None and connection.is_open:
+                    connection.close()
+
+
+class BatchConsumer:
+    """
+    Консьюмер write-behind режима. Сообщения команд из batch_handlers копятся до batch_size штук
+    или flush_interval секунд, записываются одним вызовом и подтверждаются одним ack с multiple=True.
+    Остальные команды обрабатываются по одной, предварительно сбросив накопленную пачку этого консьюмера.
+    Порядок между консьюмерами не гарантируется: конец сессии может быть записан раньше её бросков из пачек
+    других консьюмеров, поэтому время конца приходит в сообщении, а броски несут свой session_id.
+    """
+
+    def __init__(self, broker_layer, batch_size, flush_interval):
+        self.broker_layer = broker_layer
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.connection = None
+        self.channel = None
+        self.pending = {command: [] for command in broker_layer.batch_handlers}
+        self.last_delivery_tag = None
+        self.first_pending_at = None
+        # running сбрасывает только stop(); consuming — соединение открыто и подписка оформлена
+        self.running = True
+        self.consuming = False
+
     def run(self):
-        # Запуск Consumer’а в потоке
-        consumer_thread = threading.Thread(target=self.start_consuming)
-        consumer_thread.daemon = True
-        consumer_thread.start()
-        print("MsgBrokerLayer: Consumer thread started")
\ No newline at end of file
+        """Один сеанс соединения: возвращается после stop(), при обрыве бросает исключение pika."""
+        # Неподтверждённые сообщения прошлого соединения брокер доставит заново, их delivery_tag больше не действуют
+        self.clear_pending()
+        self.consuming = False
+        self.connection, self.channel = self.broker_layer.open_channel()
+        # prefetch ограничивает число неподтверждённых сообщений размером пачки
+        self.channel.basic_qos(prefetch_count=self.batch_size)
+        for command in self.broker_layer.command_handlers.keys():
+            queue_name = f"{command}_queue"
+            if command in self.broker_layer.batch_handlers:
+                on_message = self.collect(command)
+            else:
+                on_message = self.process_single(command)
+            self.channel.basic_consume(queue=queue_name, on_message_callback=on_message)
+            print(f"MsgBrokerLayer: Started consuming from '{queue_name}'")
+
+        self.consuming = True
+        try:
+            while self.running:
+                self.connection.process_data_events(time_limit=self.flush_interval)
+                if self.first_pending_at is not None and time.monotonic() - self.first_pending_at >= self.flush_interval:
+                    self.flush()
+            self.flush()
+        finally:
+            if self.connection.is_open:
+                self.connection.close()
+
+    def stop(self):
+        self.running = False
+
+    def collect(self, command):
+        def _collect(ch, method, properties, body):
+            try:
+                data = json.loads(body.decode())
+            except ValueError as e:
+                # Битое сообщение не должно возвращаться в очередь бесконечно
+                print(f"MsgBrokerLayer: Dropping malformed message from {command}_queue: {e}")
+                self.flush()
+                ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+                return
+            self.pending[command].append((method.delivery_tag, method.redelivered, data))
+            self.last_delivery_tag = method.delivery_tag
+            if self.first_pending_at is None:
+                self.first_pending_at = time.monotonic()
+            if sum(len(items) for items in self.pending.values()) >= self.batch_size:
+                self.flush()
+        return _collect
+
+    def process_single(self, command):
+        handle = self.broker_layer.callback(command)
+
+        def _process(ch, method, properties, body):
+            self.flush()
+            handle(ch, method, properties, body)
+        return _process
+
+    def flush(self):
+        if self.last_delivery_tag is None:
+            return
+        started = time.perf_counter()
+        try:
+            for command, items in self.pending.items():
+                if items:
+                    self.broker_layer.batch_handlers[command]([data for _, _, data in items])
+                    metrics.inc("broker_consumed_messages_total", len(items), command=command)
+            # Один ack подтверждает все сообщения пачки на этом канале
+            self.channel.basic_ack(delivery_tag=self.last_delivery_tag, multiple=True)
+            metrics.observe("broker_consume_batch_duration_seconds", time.perf_counter() - started)
+        except CONNECTION_ERRORS as e:
+            # База недоступна: вся пачка вернётся в очередь и запишется после переподключения
+            print(f"MsgBrokerLayer: Error flushing batch: {e}")
+            metrics.inc("broker_consume_failures_total")
+            self.channel.basic_nack(delivery_tag=self.last_delivery_tag, multiple=True, requeue=True)
+        except Exception as e:
+            # Пачку отвергла сама база (например, DataError одного броска): повторяем поштучно,
+            # чтобы один плохой бросок не возвращал в очередь всю пачку снова и снова
+            print(f"MsgBrokerLayer: Batch rejected, processing messages one by one: {e}")
+            metrics.inc("broker_consume_failures_total")
+            self.flush_one_by_one()
+        finally:
+            self.clear_pending()
+
+    def clear_pending(self):
+        for items in self.pending.values():
+            items.clear()
+        self.last_delivery_tag = None
+        self.first_pending_at = None
+
+    def flush_one_by_one(self):
+        # Запись идемпотентна (roll_uid), поэтому уже записанные броски пачки повторно не вставятся
+        for command, items in self.pending.items():
+            handler = self.broker_layer.batch_handlers[command]
+            for delivery_tag, redelivered, data in items:
+                try:
+                    handler([data])
+                    metrics.inc("broker_consumed_messages_total", command=command)
+                    self.channel.basic_ack(delivery_tag=delivery_tag)
+                except Exception as e:
+                    # Как в MsgBrokerLayer.callback: первая неудача получает ещё одну доставку,
+                    # повторно доставленное сообщение откладывается и больше в очередь не идёт
+                    if should_requeue(redelivered, e):
+                        print(f"MsgBrokerLayer: Error processing {command}, requeued: {e}")
+                        self.channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+                    else:
+                        self.broker_layer.reject_message(command, data, e)
+                        self.channel.basic_nack(delivery_tag=delivery_tag, requeue=False)
+
+
+class PublisherMetrics:
+    """Счётчики и задержки публикаций: от постановки в очередь до подтверждения брокером."""
+
+    def __init__(self, window=1024):
+        self._lock = threading.Lock()
+        self.published = 0
+        self.failed = 0
+        self.batches = 0
+        self.reconnects = 0
+        # Последние задержки (сек) и моменты подтверждения для перцентилей и пропускной способности
+        self._latencies = deque(maxlen=window)
+        self._confirmed_at = deque(maxlen=window)
+
+    def record_batch(self, enqueued_times):
+        now = time.monotonic()
+        with self._lock:
+            self.batches += 1
+            self.published += len(enqueued_times)
+            for enqueued_at in enqueued_times:
+                self._latencies.append(now - enqueued_at)
+                self._confirmed_at.append(now)
+        metrics.inc("broker_published_total", len(enqueued_times))
+        for enqueued_at in enqueued_times:
+            metrics.observe("broker_publish_latency_seconds", now - enqueued_at)
+
+    def record_failure(self, count):
+        with self._lock:
+            self.failed += count
+        metrics.inc("broker_publish_failures_total", count)
+
+    def record_reconnect(self):
+        with self._lock:
+            self.reconnects += 1
+        metrics.inc("broker_reconnects_total")
+
+    def snapshot(self, queue_depth=0):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            confirmed_at = list(self._confirmed_at)
+            stats = {
+                "published": self.published,
+                "failed": self.failed,
+                "batches": self.batches,
+                "reconnects": self.reconnects,
+                "queue_depth": queue_depth,
+            }
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+
+        stats["latency_ms"] = {"p50": percentile(0.50), "p95": percentile(0.95), "p99": percentile(0.99)}
+        span = confirmed_at[-1] - confirmed_at[0] if len(confirmed_at) > 1 else 0
+        stats["throughput_per_sec"] = (len(confirmed_at) - 1) / span if span > 0 else None
+        return stats
+
+
+class ConfirmedPublisher:
+    """
+    Публикация с подтверждениями брокера (publisher confirms) из одного выделенного потока. Потоки Flask только
+    кладут сообщения в очередь и получают Future; поток держит асинхронное SelectConnection в режиме
+    confirm_delivery, публикует до batch_size сообщений за проход и не ждёт подтверждения каждого: брокер
+    подтверждает их Basic.Ack, часто сразу пачкой (multiple), и Future разрешаются по мере подтверждений.
+    Неподтверждённые сообщения при обрыве соединения публикуются заново после переподключения
+    (не больше max_attempts раз); отвергнутые брокером (Basic.Nack) завершаются ошибкой.
+    """
+
+    def __init__(self, broker_layer):
+        self.broker_layer = broker_layer
+        self.batch_size = int(os.getenv("BROKER_PUBLISH_BATCH", "100"))
+        # Хотя бы одна попытка публикации
+        self.max_attempts = max(1, int(os.getenv("BROKER_PUBLISH_ATTEMPTS", "3")))
+        self.max_reconnect_delay = float(os.getenv("BROKER_RECONNECT_MAX_DELAY", "10"))
+        # Предел неподтверждённых сообщений: дальше поток ждёт подтверждений, а не публикует
+        self.max_unconfirmed = int(os.getenv("BROKER_PUBLISH_WINDOW", "1000"))
+        self._queue = queue.Queue(maxsize=int(os.getenv("BROKER_PUBLISH_QUEUE", "10000")))
+        self.metrics = PublisherMetrics()
+        metrics.gauge_callback("broker_publish_queue_depth", self._queue.qsize)
+        self.connection = None
+        self.channel = None
+        # Состояние ниже меняют только колбэки ioloop потока публикации.
+        # Сообщения, не подтверждённые до обрыва соединения: публикуются первыми после переподключения
+        self._retry = deque()
+        # delivery_tag -> сообщение; номера идут с 1 заново на каждом канале
+        self._unconfirmed = {}
+        self._delivery_tag = 0
+        self._drain_timer = None
+        self.running = False
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self.running = True
+        self._thread = threading.Thread(target=self._run, name="broker-publisher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+        self._wakeup()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def publish(self, routing_key, body, exchange=''):
+        future = Future()
+        try:
+            # [exchange, routing_key, body, future, время постановки, попыток]
+            self._queue.put_nowait([exchange, routing_key, body, future, time.monotonic(), 0])
+        except queue.Full:
+            self.metrics.record_failure(1)
+            raise RuntimeError("Publisher queue is full")
+        self._wakeup()
+        return future
+
+    def stats(self):
+        return self.metrics.snapshot(queue_depth=self._queue.qsize())
+
+    def _wakeup(self):
+        connection = self.connection
+        if connection is not None and connection.is_open:
+            try:
+                connection.ioloop.add_callback_threadsafe(self._drain)
+            except Exception:
+                # Соединение закрылось между проверкой и вызовом: сообщение опубликуется после переподключения
+                pass
+
+    def _run(self):
+        reconnect_delay = 0.5
+        while self.running or not self._queue.empty() or self._retry:
+            self._delivery_tag = 0
+            self._drain_timer = None
+            self.connection = pika.SelectConnection(
+                self.broker_layer.connection_parameters(),
+                on_open_callback=self._on_connection_open,
+                on_open_error_callback=self._on_connection_error,
+                on_close_callback=self._on_connection_closed,
+            )
+            self.connection.ioloop.start()
+            if self.channel is not None:
+                reconnect_delay = 0.5
+            self.channel = None
+            if not self.running and self._queue.empty() and not self._retry:
+                break
+            self.metrics.record_reconnect()
+            time.sleep(reconnect_delay)
+            reconnect_delay = min(reconnect_delay * 2, self.max_reconnect_delay)
+        self.connection = None
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_error(self, connection, error):
+        print(f"MsgBrokerLayer: Publisher reconnect failed: {error}")
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reason):
+        if self._unconfirmed:
+            print(f"MsgBrokerLayer: Publisher connection lost with {len(self._unconfirmed)} unconfirmed messages: {reason}")
+        self._requeue_unconfirmed(reason)
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        self.channel = channel
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.confirm_delivery(ack_nack_callback=self._on_confirm, callback=lambda _: self._drain())
+
+    def _on_channel_closed(self, channel, reason):
+        # Канал закрывается брокером, например при ошибке публикации: закрываем и соединение, затем переподключаемся
+        print(f"MsgBrokerLayer: Publisher channel closed: {reason}")
+        if self.connection is not None and self.connection.is_open:
+            self.connection.close()
+
+    def _next_message(self):
+        if self._retry:
+            return self._retry.popleft()
+        try:
+            return self._queue.get_nowait()
+        except queue.Empty:
+            return None
+
+    def _drain(self):
+        """Публикует ожидающие сообщения, пока позволяет окно неподтверждённых. Выполняется в ioloop."""
+        if self.channel is None or not self.channel.is_open:
+            return
+        published = 0
+        while published < self.batch_size and len(self._unconfirmed) < self.max_unconfirmed:
+            message = self._next_message()
+            if message is None:
+                break
+            exchange, routing_key, body, _, _, _ = message
+            try:
+                self.channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body,
+                                           properties=pika.BasicProperties(delivery_mode=2))
+            except pika.exceptions.AMQPError as e:
+                print(f"MsgBrokerLayer: Publish failed, reconnecting: {e}")
+                self._retry.appendleft(message)
+                self.connection.close()
+                return
+            message[5] += 1
+            self._delivery_tag += 1
+            self._unconfirmed[self._delivery_tag] = message
+            published += 1
+        if published == self.batch_size:
+            # Очередь, возможно, не пуста: продолжаем после обработки входящих подтверждений
+            self.connection.ioloop.add_callback_threadsafe(self._drain)
+        elif not self.running and not self._unconfirmed and not self._retry and self._queue.empty():
+            self.connection.close()
+        elif self._drain_timer is None:
+            # Страховка от пропущенного пробуждения, не больше одного таймера
+            self._drain_timer = self.connection.ioloop.call_later(1, self._on_drain_timer)
+
+    def _on_drain_timer(self):
+        self._drain_timer = None
+        self._drain()
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        if method.multiple:
+            tags = [tag for tag in self._unconfirmed if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+        messages = [self._unconfirmed.pop(tag) for tag in tags if tag in self._unconfirmed]
+        if isinstance(method, pika.spec.Basic.Ack):
+            self.metrics.record_batch([message[4] for message in messages])
+            for message in messages:
+                message[3].set_result(True)
+        else:
+            print(f"MsgBrokerLayer: Broker rejected {len(messages)} messages")
+            self.metrics.record_failure(len(messages))
+            for message in messages:
+                message[3].set_exception(RuntimeError("Message was nacked by the broker"))
+        if len(self._unconfirmed) < self.max_unconfirmed:
+            self._drain()
+
+    def _requeue_unconfirmed(self, error):
+        """Неподтверждённые сообщения публикуются заново; исчерпавшие попытки завершаются ошибкой."""
+        messages = [self._unconfirmed[tag] for tag in sorted(self._unconfirmed)]
+        self._unconfirmed.clear()
+        failed = [message for message in messages if message[5] >= self.max_attempts]
+        if failed:
+            self.metrics.record_failure(len(failed))
+            for message in failed:
+                message[3].set_exception(pika.exceptions.AMQPConnectionError(str(error)))
+        # Порядок сохраняется: неподтверждённые раньше ещё не опубликованных повторов
+        self._retry.extendleft(reversed([message for message in messages if message[5] < self.max_attempts]))
@@ -0,0 +1,371 @@
+"""
+Локальная колоночная реплика данных для графиков.
+Новые строки rolls, dice_results и users подтягиваются из базы по водяному знаку id и дописываются в конец
+бинарных колонок на диске (по файлу на колонку), которые читаются через numpy.memmap. Таблица sessions
+маленькая и меняется (end_session), поэтому она перечитывается целиком.
+Синхронизация идёт в фоновом потоке: раз в REPLICA_SYNC_INTERVAL секунд он сверяет версию данных DBLayer
+и ходит в базу, только если в неё писали (или реплика старше REPLICA_MAX_STALENESS). Графики всегда читают
+локальные колонки и в базу не обращаются.
+Число строк, записанных во все колонки таблицы, фиксируется в meta.json только после того, как дописаны и
+сброшены на диск все её колонки; при открытии колонки обрезаются до этого числа, поэтому оборванная
+посреди дописывания синхронизация не оставляет колонки разной длины.
+Методы чтения называются так же и возвращают строки того же вида, что и у DBLayer, поэтому VisualizationLayer
+в режиме CHART_DATA_SOURCE=replica подставляет реплику вместо базы: агрегаты считаются векторно в NumPy
+без запросов через WAN.
+"""
+
+import json
+import os
+import threading
+import time
+
+import numpy as np
+from dotenv import load_dotenv
+
+from layers.db_layer import CRITICAL_FAILURE, CRITICAL_SUCCESS, DICE_FACES, DataVersion, add_face_counts
+from layers.metrics_layer import metrics
+
+# Колонки таблиц, которые дописываются по водяному знаку id
+APPEND_TABLES = {
+    "rolls": [("id", np.int64), ("user_id", np.int64), ("session_id", np.int64), ("total_result", np.int16)],
+    "dice_results": [("id", np.int64), ("roll_id", np.int64), ("dice_result", np.int8)],
+}
+# NULL в целочисленной колонке
+MISSING_ID = -1
+
+
+class ReplicaLayer:
+    def __init__(self, db_layer, path=None):
+        load_dotenv()
+        self.db_layer = db_layer
+        self.path = path or os.getenv("REPLICA_DIR", "replica")
+        # Строк за один запрос синхронизации
+        self.batch_size = int(os.getenv("REPLICA_SYNC_BATCH", "50000"))
+        # Насколько ниже водяного знака перечитывать: id из nextval могут закоммититься не по порядку
+        self.overlap = int(os.getenv("REPLICA_SYNC_OVERLAP", "1000"))
+        # Как часто фоновый поток проверяет, не писали ли в базу
+        self.sync_interval = float(os.getenv("REPLICA_SYNC_INTERVAL", "2"))
+        # Даже без записей в этом процессе реплика синхронизируется не реже, чем раз в столько секунд
+        self.max_staleness = float(os.getenv("REPLICA_MAX_STALENESS", "60"))
+        self.data_version = DataVersion()
+        self._sync_lock = threading.Lock()
+        self._synced_upstream = None
+        self._synced_at = 0.0
+        self._wakeup = threading.Event()
+        self._thread = None
+
+        os.makedirs(self.path, exist_ok=True)
+        self.watermarks = {"rolls": 0, "dice_results": 0, "users": 0}
+        # Число строк, записанных во все колонки таблицы; None — реплика старого формата без счётчиков
+        self.row_counts = {table: None for table in APPEND_TABLES}
+        meta_path = os.path.join(self.path, "meta.json")
+        synced_before = os.path.exists(meta_path)
+        if synced_before:
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            # Старый формат meta.json — только водяные знаки
+            self.watermarks.update(meta["watermarks"] if "watermarks" in meta else meta)
+            self.row_counts.update(meta.get("rows", {}))
+        self.users = {}
+        users_path = os.path.join(self.path, "users.json")
+        if os.path.exists(users_path):
+            with open(users_path, encoding="utf-8") as f:
+                self.users = {int(user_id): name for user_id, name in json.load(f).items()}
+        self.sessions = self._load_sessions()
+        self.columns = {table: self._map_table(table) for table in APPEND_TABLES}
+        if not synced_before:
+            # Пустая реплика: первый раз синхронизируемся сразу, чтобы первые графики не были пустыми
+            self.sync_if_stale()
+        self.start()
+
+    # --- хранилище ---
+
+    def _column_path(self, table, column):
+        return os.path.join(self.path, f"{table}.{column}.bin")
+
+    def _map_table(self, table):
+        """
+        Колонки таблицы как memmap только для чтения (пустой файл memmap открыть не может). Хвосты колонок
+        дальше зафиксированного числа строк — след оборванного дописывания — отрезаются.
+        """
+        lengths = {}
+        for column, dtype in APPEND_TABLES[table]:
+            path = self._column_path(table, column)
+            lengths[column] = os.path.getsize(path) // np.dtype(dtype).itemsize if os.path.exists(path) else 0
+        rows = self.row_counts[table]
+        if rows is None or rows > min(lengths.values()):
+            rows = min(lengths.values())
+        self.row_counts[table] = rows
+        columns = {}
+        for column, dtype in APPEND_TABLES[table]:
+            path = self._column_path(table, column)
+            if lengths[column] > rows:
+                print(f"ReplicaLayer: Truncating {table}.{column} to {rows} committed rows")
+                os.truncate(path, rows * np.dtype(dtype).itemsize)
+            if rows > 0:
+                columns[column] = np.memmap(path, dtype=dtype, mode="r", shape=(rows,))
+            else:
+                columns[column] = np.empty(0, dtype=dtype)
+        return columns
+
+    def _append(self, table, arrays):
+        """Дописывает строки во все колонки и только затем фиксирует их число и водяной знак в meta.json."""
+        for column, dtype in APPEND_TABLES[table]:
+            with open(self._column_path(table, column), "ab") as f:
+                f.write(np.ascontiguousarray(arrays[column], dtype=dtype).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        self.row_counts[table] += len(arrays["id"])
+        self._write_meta()
+
+    def _write_meta(self):
+        self._write_json("meta.json", {"watermarks": self.watermarks, "rows": self.row_counts})
+
+    def _load_sessions(self):
+        path = os.path.join(self.path, "sessions.npz")
+        if not os.path.exists(path):
+            return {"id": np.empty(0, np.int64), "start": np.empty(0, "datetime64[us]"),
+                    "end": np.empty(0, "datetime64[us]")}
+        with np.load(path) as data:
+            return {key: data[key] for key in ("id", "start", "end")}
+
+    def _write_json(self, name, payload):
+        # Через временный файл, чтобы оборванная запись не испортила метаданные
+        path = os.path.join(self.path, name)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(payload, f)
+        os.replace(path + ".tmp", path)
+
+    # --- синхронизация ---
+
+    def start(self):
+        """Запускает фоновый поток синхронизации; повторный вызов ничего не делает."""
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._sync_loop, name="replica-sync", daemon=True)
+            self._thread.start()
+
+    def request_sync(self):
+        """Просит фоновый поток проверить базу сейчас, не дожидаясь интервала. Сам не блокируется."""
+        self._wakeup.set()
+
+    def _sync_loop(self):
+        while True:
+            self._wakeup.wait(self.sync_interval)
+            self._wakeup.clear()
+            self.sync_if_stale()
+
+    def sync_if_stale(self):
+        """Синхронизируется, если в базу писали с прошлой синхронизации или реплика старше max_staleness."""
+        upstream = self.db_layer.data_version.value
+        if upstream == self._synced_upstream and time.monotonic() - self._synced_at < self.max_staleness:
+            return
+        try:
+            self.sync(upstream)
+        except Exception as e:
+            # База недоступна: графики строятся по уже синхронизированным данным
+            print(f"ReplicaLayer: Sync failed, serving replica as of last sync: {e}")
+
+    @metrics.timed("db_query_duration_seconds", query="replica_sync")
+    def sync(self, upstream=None):
+        """Подтягивает новые строки всех таблиц. Возвращает число новых строк rolls и dice_results."""
+        if upstream is None:
+            upstream = self.db_layer.data_version.value
+        with self._sync_lock:
+            changed = self._sync_users()
+            changed = self._sync_sessions() or changed
+            added = 0
+            for table in APPEND_TABLES:
+                added += self._sync_table(table)
+            self._write_meta()
+            if added or changed:
+                self.columns = {table: self._map_table(table) for table in APPEND_TABLES}
+                self.data_version.bump()
+                print(f"ReplicaLayer: Synced {added} new rows")
+            self._synced_upstream = upstream
+            self._synced_at = time.monotonic()
+        return added
+
+    def _sync_users(self):
+        changed = False
+        while True:
+            rows = self.db_layer.get_players_page(self.watermarks["users"], self.batch_size)
+            if not rows:
+                break
+            self.users.update(rows)
+            self.watermarks["users"] = rows[-1][0]
+            changed = True
+            if len(rows) < self.batch_size:
+                break
+        if changed:
+            self._write_json("users.json", self.users)
+        return changed
+
+    def _sync_sessions(self):
+        rows = self.db_layer.get_session_bounds()
+        sessions = {
+            "id": np.array([row[0] for row in rows], dtype=np.int64),
+            "start": np.array([row[1] for row in rows], dtype="datetime64[us]"),
+            "end": np.array([row[2] for row in rows], dtype="datetime64[us]"),
+        }
+        if all(np.array_equal(sessions[key], self.sessions[key], equal_nan=key != "id") for key in sessions):
+            return False
+        path = os.path.join(self.path, "sessions.npz")
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, **sessions)
+        os.replace(path + ".tmp", path)
+        self.sessions = sessions
+        return True
+
+    def _sync_table(self, table):
+        names = [column for column, _ in APPEND_TABLES[table]]
+        fetch = self.db_layer.get_rolls_after if table == "rolls" else self.db_layer.get_dice_results_after
+        existing_ids = self.columns[table]["id"]
+        after = max(0, self.watermarks[table] - self.overlap)
+        added = 0
+        while True:
+            rows = fetch(after, self.batch_size)
+            if not rows:
+                break
+            # NULL в колонках-ссылках хранится как MISSING_ID
+            data = np.array([[MISSING_ID if value is None else value for value in row] for row in rows],
+                            dtype=np.int64)
+            # Строки из окна перекрытия, которые уже есть в реплике, не дописываем повторно
+            fresh = ~np.isin(data[:, 0], existing_ids[existing_ids > after])
+            after = int(data[-1, 0])
+            self.watermarks[table] = max(self.watermarks[table], after)
+            if fresh.any():
+                self._append(table, {name: data[fresh, i] for i, name in enumerate(names)})
+                added += int(fresh.sum())
+            if len(rows) < self.batch_size:
+                break
+        return added
+
+    # --- агрегаты ---
+
+    def _rolls(self, last_session=None, session_num=None):
+        """user_id, session_id, total_result бросков, опционально только одной сессии."""
+        rolls = self.columns["rolls"]
+        user_ids, session_ids, totals = rolls["user_id"], rolls["session_id"], rolls["total_result"]
+        selected = None
+        if last_session:
+            selected = self.sessions["id"][-1] if len(self.sessions["id"]) else MISSING_ID
+        elif session_num is not None:
+            selected = session_num
+        # Как в агрегатах базы: учитываем только броски с существующей сессией и игроком
+        mask = np.isin(session_ids, self.sessions["id"]) & (user_ids != MISSING_ID)
+        if selected is not None:
+            mask &= session_ids == selected
+        return user_ids[mask], session_ids[mask], totals[mask].astype(np.int64)
+
+    def _names(self, user_ids):
+        return [self.users.get(int(user_id)) for user_id in user_ids]
+
+    @staticmethod
+    def _group(keys, totals):
+        """Векторный GROUP BY: уникальные ключи, количество, сумма и число критов на группу."""
+        unique, inverse = np.unique(keys, return_inverse=True)
+        counts = np.bincount(inverse, minlength=len(unique))
+        sums = np.bincount(inverse, weights=totals, minlength=len(unique))
+        success = np.bincount(inverse, weights=(totals >= CRITICAL_SUCCESS[0]) & (totals <= CRITICAL_SUCCESS[1]),
+                              minlength=len(unique))
+        failure = np.bincount(inverse, weights=(totals >= CRITICAL_FAILURE[0]) & (totals <= CRITICAL_FAILURE[1]),
+                              minlength=len(unique))
+        return unique, counts, sums.astype(np.int64), success.astype(np.int64), failure.astype(np.int64)
+
+    def _session_player_groups(self):
+        user_ids, session_ids, totals = self._rolls()
+        # Пара (сессия, игрок) упаковывается в один int64 ключ
+        keys, counts, sums, success, failure = self._group((session_ids << 32) | user_ids, totals)
+        return keys >> 32, keys & 0xFFFFFFFF, counts, sums, success, failure
+
+    def get_average_rolls_by_session(self, by_players=None):
+        session_list = self.sessions["id"]
+        if by_players:
+            session_ids, user_ids, counts, sums, _, _ = self._session_player_groups()
+            names = self._names(user_ids)
+            by_session = {}
+            for session_id, name, count, total in zip(session_ids.tolist(), names, counts, sums):
+                by_session.setdefault(session_id, []).append((session_id, name, total / count))
+            rows = []
+            for session_id in session_list.tolist():
+                # Сессия без бросков остаётся на графике, как в LEFT JOIN
+                rows.extend(sorted(by_session.get(session_id, [(session_id, None, None)]),
+                                   key=lambda row: (row[1] is None, row[1] or "")))
+            return rows
+        _, session_ids, totals = self._rolls()
+        index = np.searchsorted(session_list, session_ids)
+        counts = np.bincount(index, minlength=len(session_list))
+        sums = np.bincount(index, weights=totals, minlength=len(session_list))
+        return [(session_id, total / count if count else None)
+                for session_id, count, total in zip(session_list.tolist(), counts, sums)]
+
+    def get_average_rolls_by_player(self, last_session=None, session_num=None):
+        user_ids, _, totals = self._rolls(last_session, session_num)
+        unique, counts, sums, _, _ = self._group(user_ids, totals)
+        averages = sums / counts
+        order = np.argsort(averages, kind="stable")
+        names = self._names(unique[order])
+        return list(zip(names, averages[order].tolist()))
+
+    def get_critical_rolls_by_player(self, last_session=None, session_num=None):
+        """Возвращает количество критических удач (3-4) и неудач (17-18) по игрокам."""
+        user_ids, _, totals = self._rolls(last_session, session_num)
+        unique, _, _, success, failure = self._group(user_ids, totals)
+        return sorted(zip(self._names(unique), success.tolist(), failure.tolist()), key=lambda row: row[0] or "")
+
+    def get_dice_face_counts(self, last_session=None, session_num=None):
+        """Частоты граней костей за всё время, по игрокам и по сессиям, как у DBLayer.get_dice_face_counts."""
+        rolls, dice = self.columns["rolls"], self.columns["dice_results"]
+        # JOIN dice_results -> rolls по id через бинарный поиск в отсортированных id бросков
+        order = np.argsort(rolls["id"], kind="stable")
+        sorted_ids = rolls["id"][order]
+        positions = np.minimum(np.searchsorted(sorted_ids, dice["roll_id"]), max(len(sorted_ids) - 1, 0))
+        found = sorted_ids[positions] == dice["roll_id"] if len(sorted_ids) else np.zeros(len(dice["roll_id"]), bool)
+        roll_index = order[positions[found]]
+        faces = dice["dice_result"][found].astype(np.int64)
+        user_ids, session_ids = rolls["user_id"][roll_index], rolls["session_id"][roll_index]
+
+        if last_session:
+            selected = self.sessions["id"][-1] if len(self.sessions["id"]) else MISSING_ID
+        else:
+            selected = session_num
+        if selected is not None:
+            mask = session_ids == selected
+            faces, user_ids, session_ids = faces[mask], user_ids[mask], session_ids[mask]
+
+        by_user, by_session, overall = {}, {}, {}
+        add_face_counts(by_user, user_ids, faces)
+        add_face_counts(by_session, session_ids, faces)
+        add_face_counts(overall, np.zeros(len(faces), dtype=np.int64), faces)
+        return {
+            "all": overall.get(0, np.zeros(DICE_FACES, dtype=np.int64)).tolist(),
+            "players": sorted((self.users.get(user_id, str(user_id)), counts.tolist())
+                              for user_id, counts in by_user.items()),
+            "sessions": sorted((session_id, counts.tolist()) for session_id, counts in by_session.items()),
+        }
+
+    def _durations(self):
+        ended = ~np.isnat(self.sessions["end"])
+        hours = (self.sessions["end"][ended] - self.sessions["start"][ended]) / np.timedelta64(1, "h")
+        return self.sessions["id"][ended], self.sessions["start"][ended], hours
+
+    def get_session_durations(self):
+        session_ids, _, hours = self._durations()
+        return list(zip(session_ids.tolist(), hours.tolist()))
+
+    def get_weekly_session_durations(self):
+        _, starts, hours = self._durations()
+        days = starts.astype("datetime64[D]")
+        # DATE_TRUNC('week'): понедельник; 1970-01-01 был четвергом
+        weeks = days - (days.astype(np.int64) + 3) % 7
+        unique, inverse = np.unique(weeks, return_inverse=True)
+        totals = np.bincount(inverse, weights=hours, minlength=len(unique))
+        return list(zip(unique.astype("datetime64[us]").tolist(), totals.tolist()))
+
+    def get_chart_snapshot(self):
+        """Тот же снимок, что у DBLayer.get_chart_snapshot, посчитанный из реплики."""
+        session_ids, user_ids, counts, sums, success, failure = self._session_player_groups()
+        rollups = sorted(zip(session_ids.tolist(), self._names(user_ids), counts.tolist(), sums.tolist(),
+                             success.tolist(), failure.tolist()),
+                         key=lambda row: (row[0], row[1] or ""))
+        return {"session_ids": self.sessions["id"].tolist(), "rollups": rollups}
@@ -0,0 +1,76 @@
+"""
+Данный модуль хранит активные сессии столов: один сервер принимает броски нескольких столов Tabletop Simulator
+одновременно, и у каждого стола своя сессия. Стол определяется заголовком X-Table-Id, параметром ?table=
+или полем table в теле броска; запросы без него относятся к столу default, как до появления столов.
+Поиск сессии стола — обращение к словарю под блокировкой, O(1) на запрос.
+"""
+
+import threading
+
+DEFAULT_TABLE = "default"
+MAX_TABLE_ID_LENGTH = 64
+
+
+def resolve_table_id(header_value=None, data=None):
+    """Id стола из заголовка или поля table тела запроса. Слишком длинный id — ValueError."""
+    table_id = header_value or (data.get("table") if isinstance(data, dict) else None) or DEFAULT_TABLE
+    table_id = str(table_id)
+    if len(table_id) > MAX_TABLE_ID_LENGTH:
+        raise ValueError(f"Table id longer than {MAX_TABLE_ID_LENGTH} characters")
+    return table_id
+
+
+class TableSession:
+    """Состояние активной сессии одного стола."""
+
+    __slots__ = ("table_id", "session_id", "started_at")
+
+    def __init__(self, table_id, session_id, started_at):
+        self.table_id = table_id
+        self.session_id = session_id
+        self.started_at = started_at
+
+
+class SessionRegistry:
+    """Потокобезопасный реестр стол -> активная сессия."""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def session_id(self, table_id):
+        """Id активной сессии стола или 0, если сессия не начата."""
+        session = self._sessions.get(table_id)
+        return session.session_id if session is not None else 0
+
+    def get(self, table_id):
+        return self._sessions.get(table_id)
+
+    def start(self, table_id, session_id, started_at):
+        """Делает сессию активной для стола. Возвращает предыдущую сессию стола или None."""
+        with self._lock:
+            previous = self._sessions.get(table_id)
+            self._sessions[table_id] = TableSession(table_id, session_id, started_at)
+            return previous
+
+    def end(self, table_id, session_id=None):
+        """
+        Убирает активную сессию стола и возвращает её (или None). С session_id убирает, только если
+        активна именно она: сессию, начатую заново, пока завершалась прежняя, не трогает.
+        """
+        with self._lock:
+            session = self._sessions.get(table_id)
+            if session is None or (session_id is not None and session.session_id != session_id):
+                return None
+            return self._sessions.pop(table_id)
+
+    def restore(self, open_sessions):
+        """Восстанавливает сессии после перезапуска из строк (session_id, table_id, session_start)."""
+        with self._lock:
+            for session_id, table_id, started_at in open_sessions:
+                self._sessions[table_id] = TableSession(table_id, session_id, started_at)
+        if open_sessions:
+            print(f"SessionRegistry: Restored {len(open_sessions)} active table sessions")
+
+    def __len__(self):
+        return len(self._sessions)
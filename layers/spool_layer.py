@@ -0,0 +1,253 @@
+"""
+Данный модуль — локальный спул бросков на диске на случай, когда база или брокер недоступны.
+Спул — журнал сегментов фиксированного размера, отображённых в память (mmap): запись броска — это копирование
+нескольких сотен байт в память под блокировкой, поэтому /roll отвечает за микросекунды. Страницы сбрасываются
+на диск фоновым потоком раз в SPOOL_FSYNC_INTERVAL (пачкой, а не на каждый бросок); падение процесса записи
+не теряет — они уже в page cache, падение ОС теряет не больше одного интервала.
+Фоновый replayer читает записи с контрольной точки, пачками пишет их в базу через DBLayer.record_rolls_batch
+и после каждого коммита сохраняет контрольную точку. Полностью прочитанные сегменты удаляются.
+Доставка «хотя бы один раз»: падение между коммитом и сохранением контрольной точки повторит последнюю пачку,
+но у бросков с roll_id клиента есть roll_uid, и повторённые броски база пропускает.
+
+Формат записи: [длина payload: u32][crc32 payload: u32][payload: JSON броска]. Нулевая длина — конец данных
+сегмента (файл создаётся заполненным нулями). Заголовок пишется после payload, поэтому читатель никогда
+не видит запись наполовину.
+"""
+
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from dotenv import load_dotenv
+
+from layers.db_layer import CONNECTION_ERRORS
+from layers.metrics_layer import metrics
+
+RECORD_HEADER = struct.Struct("<II")
+
+
+def read_records(buffer, offset, limit=None):
+    """
+    Читает подряд целые записи сегмента начиная с offset. Останавливается на нулевой длине, битой CRC
+    (недописанная запись) или конце сегмента. Возвращает (список payload, смещение после последней записи).
+    """
+    records = []
+    while offset + RECORD_HEADER.size <= len(buffer) and (limit is None or len(records) < limit):
+        length, crc = RECORD_HEADER.unpack_from(buffer, offset)
+        end = offset + RECORD_HEADER.size + length
+        if length == 0 or end > len(buffer):
+            break
+        payload = bytes(buffer[offset + RECORD_HEADER.size:end])
+        if zlib.crc32(payload) != crc:
+            break
+        records.append(payload)
+        offset = end
+    return records, offset
+
+
+class SpoolLayer:
+    def __init__(self, db_layer, path=None):
+        load_dotenv()
+        self.db_layer = db_layer
+        self.path = path or os.getenv("SPOOL_DIR", "spool")
+        self.segment_bytes = int(os.getenv("SPOOL_SEGMENT_BYTES", str(16 * 1024 * 1024)))
+        # Как часто сбрасывать записанные страницы на диск
+        self.fsync_interval = float(os.getenv("SPOOL_FSYNC_INTERVAL", "0.05"))
+        # Сколько бросков replayer пишет в базу одной пачкой
+        self.replay_batch = int(os.getenv("SPOOL_REPLAY_BATCH", "500"))
+        # Предельная пауза между попытками, пока база недоступна
+        self.max_retry_delay = float(os.getenv("SPOOL_MAX_RETRY_DELAY", "30"))
+        os.makedirs(self.path, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._dirty = False
+        self._threads = []
+        self._reader = None
+
+        self.checkpoint = self._load_checkpoint()
+        segments = self._segments()
+        self._open_writer(segments[-1] if segments else self.checkpoint[0])
+        # Дописываем после последней целой записи; хвост недописанной записи затираем
+        _, self._offset = read_records(self._mm, 0)
+        if any(self._mm[self._offset:self._offset + RECORD_HEADER.size]):
+            self._mm[self._offset:] = bytes(self.segment_bytes - self._offset)
+        metrics.gauge_callback("spool_backlog_bytes", self.backlog_bytes)
+
+    # --- сегменты ---
+
+    def _segment_path(self, number):
+        return os.path.join(self.path, f"{number:08d}.seg")
+
+    def _segments(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.path) if name.endswith(".seg"))
+
+    def _map_segment(self, number, access):
+        path = self._segment_path(number)
+        with open(path, "a+b") as f:
+            if os.path.getsize(path) < self.segment_bytes:
+                f.truncate(self.segment_bytes)
+            return mmap.mmap(f.fileno(), self.segment_bytes, access=access)
+
+    def _open_writer(self, number):
+        self._segment = number
+        self._mm = self._map_segment(number, mmap.ACCESS_WRITE)
+        self._offset = 0
+
+    def _load_checkpoint(self):
+        path = os.path.join(self.path, "checkpoint.json")
+        if not os.path.exists(path):
+            segments = self._segments()
+            return (segments[0] if segments else 1), 0
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return data["segment"], data["offset"]
+
+    def _save_checkpoint(self, checkpoint):
+        path = os.path.join(self.path, "checkpoint.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"segment": checkpoint[0], "offset": checkpoint[1]}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        self.checkpoint = checkpoint
+
+    def backlog_bytes(self):
+        """Сколько байт записано в спул, но ещё не отдано в базу."""
+        segment, offset = self.checkpoint
+        return (self._segment - segment) * self.segment_bytes + self._offset - offset
+
+    # --- запись ---
+
+    def append(self, roll_data):
+        self.append_many([roll_data])
+
+    def append_many(self, rolls_data):
+        """Дописывает броски в спул. Данные становятся устойчивыми к падению процесса сразу после возврата."""
+        payloads = [json.dumps(roll_data, separators=(",", ":")).encode() for roll_data in rolls_data]
+        with self._lock:
+            for payload in payloads:
+                size = RECORD_HEADER.size + len(payload)
+                if size > self.segment_bytes:
+                    raise ValueError(f"Roll of {size} bytes does not fit into a spool segment")
+                if self._offset + size > self.segment_bytes:
+                    # Сегмент заполнен: сбрасываем его на диск и открываем следующий
+                    self._mm.flush()
+                    self._mm.close()
+                    self._open_writer(self._segment + 1)
+                start = self._offset
+                self._mm[start + RECORD_HEADER.size:start + size] = payload
+                self._mm[start:start + RECORD_HEADER.size] = RECORD_HEADER.pack(len(payload), zlib.crc32(payload))
+                self._offset += size
+            self._dirty = True
+        metrics.inc("spool_appends_total", len(payloads))
+        self._wakeup.set()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.fsync_interval):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._dirty:
+                self._mm.flush()
+                self._dirty = False
+
+    # --- воспроизведение в базу ---
+
+    def _read_batch(self):
+        """Следующая пачка payload с контрольной точки и позиция после неё; переходит через дочитанные сегменты."""
+        segment, offset = self.checkpoint
+        while True:
+            if self._reader is None or self._reader[0] != segment:
+                if self._reader is not None:
+                    self._reader[1].close()
+                self._reader = (segment, self._map_segment(segment, mmap.ACCESS_READ))
+            records, end = read_records(self._reader[1], offset, self.replay_batch)
+            if records:
+                return records, (segment, end)
+            with self._lock:
+                writer_segment = self._segment
+            if segment >= writer_segment:
+                return [], (segment, offset)
+            # Сегмент дочитан, а писатель уже в следующем
+            segment, offset = segment + 1, 0
+            self._save_checkpoint((segment, offset))
+            self._drop_consumed_segments()
+
+    def _drop_consumed_segments(self):
+        for number in self._segments():
+            if number < self.checkpoint[0]:
+                os.remove(self._segment_path(number))
+
+    def _replay(self, payloads):
+        rolls_data = []
+        for payload in payloads:
+            try:
+                rolls_data.append(json.loads(payload))
+            except ValueError:
+                print(f"SpoolLayer: Skipping undecodable record: {payload[:100]!r}")
+        if not rolls_data:
+            return
+        try:
+            self.db_layer.record_rolls_batch(rolls_data)
+        except CONNECTION_ERRORS:
+            raise
+        except Exception as e:
+            # Пачку отклонила сама база (а не сеть): пишем поштучно, отклонённые откладываем в rejected.jsonl,
+            # чтобы один плохой бросок не остановил весь спул
+            print(f"SpoolLayer: Batch rejected, replaying rolls one by one: {e}")
+            for roll_data in rolls_data:
+                try:
+                    self.db_layer.record_rolls_batch([roll_data])
+                except CONNECTION_ERRORS:
+                    raise
+                except Exception as roll_error:
+                    print(f"SpoolLayer: Roll rejected by database, moved to rejected.jsonl: {roll_error}")
+                    metrics.inc("spool_rejected_total")
+                    with open(os.path.join(self.path, "rejected.jsonl"), "a", encoding="utf-8") as f:
+                        f.write(json.dumps(roll_data) + "\n")
+
+    def _replay_loop(self):
+        delay = 0.0
+        while not self._stop.is_set():
+            self._wakeup.wait(1.0)
+            self._wakeup.clear()
+            while not self._stop.is_set():
+                payloads, position = self._read_batch()
+                if not payloads:
+                    break
+                try:
+                    self._replay(payloads)
+                except Exception as e:
+                    delay = min(max(delay * 2, 1.0), self.max_retry_delay)
+                    metrics.inc("spool_replay_failures_total")
+                    print(f"SpoolLayer: Replay failed, retrying in {delay:.0f}s: {e}")
+                    self._stop.wait(delay)
+                    continue
+                delay = 0.0
+                self._save_checkpoint(position)
+                metrics.inc("spool_replayed_total", len(payloads))
+
+    def start(self):
+        for target, name in ((self._flush_loop, "spool-flush"), (self._replay_loop, "spool-replay")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        backlog = self.backlog_bytes()
+        print(f"SpoolLayer: Started in {self.path}" + (f", {backlog} bytes to replay" if backlog else ""))
+
+    def close(self):
+        self._stop.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self.flush()
+        with self._lock:
+            self._mm.close()
+        if self._reader is not None:
+            self._reader[1].close()
@@ -0,0 +1,58 @@
+"""
+Данный модуль управляет запуском сервиса: независимые шаги (подключение к базе и брокеру, импорт discord,
+ожидание туннеля ngrok) выполняются параллельно в потоках, шаги с зависимостями ждут только свои зависимости.
+У каждого шага замеряется время от начала запуска и длительность, в конце печатается разбивка
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from layers.metrics_layer import metrics
+
+
+class StartupOrchestrator:
+    def __init__(self, max_workers=8):
+        self.started = time.perf_counter()
+        # имя шага -> (начало от старта, длительность, успешно ли)
+        self.timings = {}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="startup")
+
+    def _timed(self, name, func, *args):
+        began = time.perf_counter()
+        succeeded = False
+        try:
+            result = func(*args)
+            succeeded = True
+            return result
+        finally:
+            duration = time.perf_counter() - began
+            self.timings[name] = (began - self.started, duration, succeeded)
+            metrics.observe("startup_step_duration_seconds", duration, step=name)
+
+    def run(self, name, func, *args):
+        """Выполняет шаг в текущем потоке."""
+        return self._timed(name, func, *args)
+
+    def step(self, name, func, after=()):
+        """
+        Запускает шаг в фоне, когда завершатся шаги after; их результаты передаются в func по порядку.
+        Возвращает Future; ошибка шага или его зависимости поднимется при future.result().
+        Ожидание зависимостей в длительность шага не входит.
+        """
+        def run():
+            return self._timed(name, func, *[dependency.result() for dependency in after])
+        return self.executor.submit(run)
+
+    @staticmethod
+    def is_done(future):
+        """Для проверок готовности: шаг завершился без ошибки."""
+        return future.done() and not future.cancelled() and future.exception() is None
+
+    def report(self):
+        print("Startup: timing breakdown (start offset, duration)")
+        for name, (offset, duration, succeeded) in sorted(self.timings.items(), key=lambda item: item[1][0]):
+            print(f"Startup:   {name:<12} +{offset:6.2f}s {duration:6.2f}s{'' if succeeded else '  FAILED'}")
+        print(f"Startup: total {time.perf_counter() - self.started:.2f}s")
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,134 @@
+"""
+Данный модуль держит статистику бросков в памяти процесса: по игрокам, по сессиям, по игрокам внутри сессий
+и за всё время. Каждый бросок обновляет её за O(1) алгоритмом Уэлфорда (число, среднее, сумма квадратов
+отклонений M2 -> дисперсия), плюс минимум, максимум и критические броски. При старте статистика
+восстанавливается из базы одним агрегирующим запросом: моменты групп (сессия, игрок) сливаются формулой
+Чана. Дальше её питает DBLayer после коммита каждой записи, поэтому повторно доставленные броски,
+которые база пропустила по roll_uid, в статистику не попадают.
+"""
+
+import math
+import threading
+
+from layers.db_layer import CRITICAL_FAILURE, CRITICAL_SUCCESS
+
+
+class RunningStats:
+    __slots__ = ("count", "mean", "m2", "min", "max", "critical_success", "critical_failure")
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.critical_success = 0
+        self.critical_failure = 0
+
+    def add(self, total):
+        self.count += 1
+        delta = total - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (total - self.mean)
+        self.min = total if self.min is None else min(self.min, total)
+        self.max = total if self.max is None else max(self.max, total)
+        self.critical_success += CRITICAL_SUCCESS[0] <= total <= CRITICAL_SUCCESS[1]
+        self.critical_failure += CRITICAL_FAILURE[0] <= total <= CRITICAL_FAILURE[1]
+
+    def merge(self, other):
+        """Добавляет статистику другой группы (параллельная формула Чана для среднего и M2)."""
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.critical_success += other.critical_success
+        self.critical_failure += other.critical_failure
+
+    @classmethod
+    def from_moments(cls, count, mean, variance, minimum, maximum, critical_success, critical_failure):
+        """Статистика группы из агрегатов SQL (variance — популяционная, VAR_POP)."""
+        stats = cls()
+        stats.count = count
+        stats.mean = float(mean)
+        stats.m2 = float(variance) * count
+        stats.min = minimum
+        stats.max = maximum
+        stats.critical_success = critical_success
+        stats.critical_failure = critical_failure
+        return stats
+
+    def as_dict(self):
+        # Выборочная дисперсия (n - 1), как у pandas
+        variance = self.m2 / (self.count - 1) if self.count > 1 else 0.0
+        return {
+            "count": self.count,
+            "mean": round(self.mean, 4) if self.count else None,
+            "variance": round(variance, 4),
+            "stddev": round(math.sqrt(variance), 4),
+            "min": self.min,
+            "max": self.max,
+            "critical_success": self.critical_success,
+            "critical_failure": self.critical_failure,
+        }
+
+
+class StatsEngine:
+    def __init__(self):
+        self.all_time = RunningStats()
+        self.players = {}
+        self.sessions = {}
+        # session_id -> {игрок: статистика}
+        self.session_players = {}
+        self._lock = threading.Lock()
+        self.ready = False
+
+    def _add(self, session_id, player, stats_update):
+        session_players = self.session_players.setdefault(session_id, {})
+        for key, groups in ((player, self.players), (session_id, self.sessions), (player, session_players)):
+            stats = groups.get(key)
+            if stats is None:
+                stats = groups[key] = RunningStats()
+            stats_update(stats)
+        stats_update(self.all_time)
+
+    def record_rolls(self, rolls_data):
+        """Учитывает записанные в базу броски. Подписывается на DBLayer.roll_listeners."""
+        with self._lock:
+            for roll_data in rolls_data:
+                total = roll_data['total']
+                self._add(roll_data['session_id'], roll_data['player'], lambda stats: stats.add(total))
+
+    def rebuild(self, db_layer):
+        """Пересобирает статистику по всей истории бросков в базе."""
+        rows = db_layer.get_roll_moments()
+        with self._lock:
+            self.all_time = RunningStats()
+            self.players, self.sessions, self.session_players = {}, {}, {}
+            for session_id, player, *moments in rows:
+                group = RunningStats.from_moments(*moments)
+                self._add(session_id, player, lambda stats: stats.merge(group))
+            self.ready = True
+        print(f"StatsEngine: Rebuilt from {self.all_time.count} rolls in {len(self.sessions)} sessions")
+
+    def overview(self):
+        with self._lock:
+            return {
+                "all_time": self.all_time.as_dict(),
+                "players": {player: stats.as_dict() for player, stats in self.players.items()},
+                "sessions": len(self.sessions),
+            }
+
+    def session(self, session_id):
+        """Статистика сессии и её игроков; у сессии без бросков count равен 0."""
+        with self._lock:
+            return {
+                "session_id": session_id,
+                "all": self.sessions.get(session_id, RunningStats()).as_dict(),
+                "players": {player: stats.as_dict()
+                            for player, stats in self.session_players.get(session_id, {}).items()},
+            }
@@ -1,119 +1,502 @@
 """Данный модуль осуществляет асинхронную генерацию графиков для будущего вывода их в чате discord
 Модуль подсчиняется слою bot_layer
+Каждый график разделён на запрос данных (в процессе бота, через DBLayer) и чистую функцию отрисовки, которая
+получает строки из базы и возвращает PNG-байты. Отрисовка идёт на собственных объектах Figure/FigureCanvasAgg
+без глобального состояния pyplot, по умолчанию — в пуле прогретых процессов ChartRenderPool, чтобы рендер
+matplotlib/pandas не держал GIL процесса с discord-шлюзом и приёмом бросков.
+Готовые PNG кэшируются по типу графика, параметрам и версии данных DBLayer: пока в базу ничего не записано,
+повторная команда отдаёт картинку без запроса к базе и без matplotlib.
+pandas и matplotlib импортируются внутри функций отрисовки: в процессе бота они не загружаются вовсе
+(рисуют воркеры пула) или загружаются при первом графике, а не при старте сервиса.
+С CHART_DATA_SOURCE=replica данные читаются из локальной реплики ReplicaLayer вместо запросов к базе
 """
 
-import matplotlib
-matplotlib.use("Agg")  # Устанавливаем бэкенд Agg (потокобезопасный)
-import pandas as pd
-import matplotlib.pyplot as plt
+import io
+import multiprocessing
 import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from dotenv import load_dotenv
+from layers.db_layer import DICE_FACES, chi_square_fairness
+from layers.metrics_layer import metrics
 
-class VisualizationLayer:
-    def __init__(self, db_layer):
-        self.db_layer = db_layer
 
-    def plot_average_rolls_by_session(self, by_players=None, filename="average_rolls_by_session.png"):
-        """Линейный график средних значений бросков по сессиям."""
-        plt.figure(figsize=(8, 6))
-        data = self.db_layer.get_average_rolls_by_session(by_players)
+def new_figure(figsize=(8, 6)):
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig, fig.add_subplot()
+
+
+def figure_to_png(fig):
+    buffer = io.BytesIO()
+    fig.canvas.print_png(buffer)
+    return buffer.getvalue()
+
+
+def session_suffix(last_session, session_num):
+    return " (Last Session)" if last_session else f" (Session {session_num})" if session_num is not None else ""
+
+
+def render_average_rolls_by_session(data, by_players):
+    """Линейный график средних значений бросков по сессиям."""
+    import pandas as pd
+    fig, ax = new_figure()
+    if by_players:
+        df = pd.DataFrame(data, columns=["session_id", "user_name", "avg_result"])
+        for user in df["user_name"].unique():
+            user_data = df[df["user_name"] == user]
+            ax.plot(user_data["session_id"], user_data["avg_result"], marker="o", label=user)
+        ax.legend(title="Players")
+    else:
+        df = pd.DataFrame(data, columns=["session_id", "avg_result"])
+        ax.plot(df["session_id"], df["avg_result"], marker="o")
+
+    ax.set_xlabel("Session ID")
+    ax.set_ylabel("Average Roll Result")
+    ax.set_title("Average Roll Result by Session")
+    ax.grid(True)
+    return figure_to_png(fig)
+
+
+def render_average_rolls_by_player(data, last_session, session_num):
+    """Bar-диаграмма средних значений бросков по игрокам."""
+    import pandas as pd
+    fig, ax = new_figure()
+    df = pd.DataFrame(data, columns=["user_name", "avg_result"])
+
+    ax.bar(df["user_name"], df["avg_result"])
+    ax.set_xlabel("Player")
+    ax.set_ylabel("Average Roll Result")
+    ax.set_title("Average Roll Result by Player" + session_suffix(last_session, session_num))
+    ax.tick_params(axis="x", labelrotation=45)
+    return figure_to_png(fig)
+
+
+def render_critical_rolls_by_player(data, last_session, session_num):
+    """Bar-диаграмма критических удач и неудач по игрокам."""
+    import pandas as pd
+    fig, ax = new_figure()
+    df = pd.DataFrame(data, columns=["user_name", "critical_success", "critical_failure"])
+
+    bar_width = 0.35
+    x = range(len(df["user_name"]))
+    ax.bar(x, df["critical_success"], bar_width, label="Critical Success (3-4)", color="green")
+    ax.bar([i + bar_width for i in x], df["critical_failure"], bar_width, label="Critical Failure (17-18)", color="red")
+    ax.set_xlabel("Player")
+    ax.set_ylabel("Count")
+    ax.set_title("Critical Rolls by Player" + session_suffix(last_session, session_num))
+    ax.set_xticks([i + bar_width / 2 for i in x])
+    ax.set_xticklabels(df["user_name"], rotation=45)
+    ax.legend()
+    return figure_to_png(fig)
+
+
+def render_session_durations(data, by_week):
+    """Линейный график длительности сессий, по сессиям или по неделям."""
+    import pandas as pd
+    from matplotlib.ticker import MaxNLocator
+    fig, ax = new_figure(figsize=(10, 6))
+    if by_week:
+        # Вариант 2: по неделям
+        df = pd.DataFrame(data, columns=["week_start", "total_hours"])
+        ax.plot(df["week_start"], df["total_hours"], marker="o")
+        ax.set_xlabel("Неделя")
+        ax.set_ylabel("Общая длительность (часы)")
+        ax.set_title("Длительность игровых сессий по неделям")
+        ax.tick_params(axis="x", labelrotation=45)
+    else:
+        # Вариант 1: по сессиям
+        df = pd.DataFrame(data, columns=["session_id", "duration_hours"])
+        ax.plot(df["session_id"], df["duration_hours"], marker="o")
+        ax.set_xlabel("номер сессии")
+        ax.set_ylabel("Длительность (часы)")
+        ax.set_title("Длительность игровых сессий")
+
+    # Добавляем форматирование оси Y для отображения только целых чисел
+    ax.xaxis.set_major_locator(MaxNLocator(integer=True))
+
+    ax.grid(True)
+    fig.tight_layout()
+    return figure_to_png(fig)
 
+
+def fairness_label(label, chi2, p_value):
+    if chi2 is None:
+        return f"{label}: нет данных"
+    return f"{label}: χ²={chi2:.1f}, p={p_value:.3g}"
+
+
+def render_dice_fairness(data, by_session, last_session, session_num):
+    """Доли граней костей по игрокам или сессиям относительно ожидаемой 1/6 с критерием хи-квадрат в легенде."""
+    fig, ax = new_figure(figsize=(10, 6))
+    groups = data["groups"]
+    faces = range(1, DICE_FACES + 1)
+    bar_width = 0.8 / max(len(groups), 1)
+    for i, (label, counts, chi2, p_value) in enumerate(groups):
+        total = sum(counts) or 1
+        ax.bar([face - 0.4 + bar_width * (i + 0.5) for face in faces], [count / total for count in counts],
+               bar_width, label=fairness_label(f"Session {label}" if by_session else label, chi2, p_value))
+    ax.axhline(1 / DICE_FACES, color="black", linestyle="--", linewidth=1, label="Ожидаемая доля 1/6")
+
+    all_counts, chi2, p_value = data["all"]
+    ax.set_xticks(list(faces))
+    ax.set_xlabel("Грань")
+    ax.set_ylabel("Доля выпадений")
+    ax.set_title("Честность костей" + session_suffix(last_session, session_num) +
+                 f"\n{fairness_label(f'Всего {sum(all_counts)} костей', chi2, p_value)}")
+    ax.legend(fontsize="small")
+    fig.tight_layout()
+    return figure_to_png(fig)
+
+
+RENDERERS = {
+    "average_rolls_by_session": render_average_rolls_by_session,
+    "average_rolls_by_player": render_average_rolls_by_player,
+    "critical_rolls_by_player": render_critical_rolls_by_player,
+    "session_durations": render_session_durations,
+    "dice_fairness": render_dice_fairness,
+}
+
+
+def render_chart(chart, data, params):
+    """Точка входа воркера: строки из базы и параметры графика -> PNG-байты."""
+    return RENDERERS[chart](data, *params)
+
+
+# Варианты графиков для /testcharts: имя файла, тип графика, параметры (в порядке аргументов plot_*)
+CHART_VARIANTS = [
+    ("average_rolls_by_session.png", "average_rolls_by_session", (False,)),
+    ("average_rolls_by_session_by_players.png", "average_rolls_by_session", (True,)),
+    ("average_rolls_by_player.png", "average_rolls_by_player", (False, None)),
+    ("average_rolls_by_player_last_session.png", "average_rolls_by_player", (True, None)),
+    ("average_rolls_by_player_session_1.png", "average_rolls_by_player", (False, 1)),
+    ("critical_rolls_by_player.png", "critical_rolls_by_player", (False, None)),
+    ("critical_rolls_by_player_last_session.png", "critical_rolls_by_player", (True, None)),
+    ("critical_rolls_by_player_session_1.png", "critical_rolls_by_player", (False, 1)),
+]
+
+
+def average(total, count):
+    return total / count if count else None
+
+
+def derive_chart_data(snapshot, chart, params):
+    """
+    Строит из снимка DBLayer.get_chart_snapshot те же строки, что вернул бы соответствующий get_* метод,
+    чтобы все варианты графиков считались в памяти без отдельных запросов к базе.
+    """
+    session_ids = snapshot["session_ids"]
+    rollups = snapshot["rollups"]
+
+    if chart == "average_rolls_by_session":
+        (by_players,) = params
         if by_players:
-            df = pd.DataFrame(data, columns=["session_id", "user_name", "avg_result"])
-            for user in df["user_name"].unique():
-                user_data = df[df["user_name"] == user]
-                plt.plot(user_data["session_id"], user_data["avg_result"], marker="o", label=user)
-            plt.legend(title="Players")
+            per_player = {}
+            for session_id, user_name, count, total, _, _ in rollups:
+                per_player[(session_id, user_name)] = (total, count)
+            rows = []
+            for session_id in session_ids:
+                players = sorted(name for sid, name in per_player if sid == session_id)
+                # Сессия без бросков остаётся на графике, как в LEFT JOIN
+                rows.extend((session_id, name, average(*per_player[(session_id, name)])) for name in players)
+                if not players:
+                    rows.append((session_id, None, None))
+            return rows
+        totals = {session_id: [0, 0] for session_id in session_ids}
+        for session_id, _, count, total, _, _ in rollups:
+            if session_id in totals:
+                totals[session_id][0] += total
+                totals[session_id][1] += count
+        return [(session_id, average(*totals[session_id])) for session_id in session_ids]
+
+    last_session, session_num = params
+    if last_session:
+        selected = session_ids[-1] if session_ids else None
+        rollups = [row for row in rollups if row[0] == selected]
+    elif session_num is not None:
+        rollups = [row for row in rollups if row[0] == session_num]
+
+    by_user = {}
+    for _, user_name, count, total, success, failure in rollups:
+        sums = by_user.setdefault(user_name, [0, 0, 0, 0])
+        sums[0] += count
+        sums[1] += total
+        sums[2] += success
+        sums[3] += failure
+
+    if chart == "average_rolls_by_player":
+        rows = [(name, average(sums[1], sums[0])) for name, sums in by_user.items()]
+        # ORDER BY avg_result: NULL в конце, как в Postgres
+        return sorted(rows, key=lambda row: (row[1] is None, row[1] or 0))
+    if chart == "critical_rolls_by_player":
+        return [(name, sums[2], sums[3]) for name, sums in sorted(by_user.items())]
+    raise ValueError(f"Chart {chart} cannot be derived from a snapshot")
+
+
+def warm_worker():
+    """Инициализатор процесса-воркера: один раз прогревает matplotlib/pandas (шрифты, Agg, кэш DataFrame)."""
+    render_average_rolls_by_session([(1, 10.0), (2, 11.0)], False)
+
+
+class ChartRenderBusy(Exception):
+    """Очередь рендера заполнена: новую задачу не принимаем, а сразу сообщаем пользователю."""
+
+
+class ChartRenderPool:
+    """
+    Пул процессов для отрисовки графиков с ограниченной очередью и таймаутом на задачу.
+    workers=0 — рисовать в вызывающем потоке (прежний путь через поток executor бота).
+    """
+
+    def __init__(self, workers=None, queue_size=None, timeout=None):
+        load_dotenv()
+        self.workers = int(os.getenv("CHART_WORKERS", "2")) if workers is None else workers
+        self.queue_size = int(os.getenv("CHART_QUEUE_SIZE", "16")) if queue_size is None else queue_size
+        self.timeout = float(os.getenv("CHART_RENDER_TIMEOUT", "30")) if timeout is None else timeout
+        # Задачи в работе плюс ожидающие: больше queue_size одновременно не принимаем
+        self._slots = threading.BoundedSemaphore(self.queue_size)
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.executor = None
+        if self.workers > 0:
+            self._start_executor()
+        metrics.gauge_callback("chart_render_queue_depth", lambda: self._pending)
+
+    def _start_executor(self):
+        # spawn, а не fork: процесс бота многопоточный (discord, pika, пул соединений)
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=warm_worker
+        )
+        # Поднимаем все процессы сразу, чтобы первая команда не ждала импорт matplotlib
+        for _ in range(self.workers):
+            self.executor.submit(int)
+        print(f"VisualizationLayer: Render pool started with {self.workers} workers")
+
+    def render(self, chart, data, params):
+        if not self._slots.acquire(blocking=False):
+            metrics.inc("chart_render_rejected_total", chart=chart)
+            raise ChartRenderBusy(f"Chart render queue is full ({self.queue_size} jobs)")
+        with self._lock:
+            self._pending += 1
+        try:
+            if self.executor is None:
+                return render_chart(chart, data, params)
+            executor = self.executor
+            future = executor.submit(render_chart, chart, data, params)
+            try:
+                return future.result(timeout=self.timeout)
+            except BrokenProcessPool:
+                # Воркер упал (например, убит по памяти): пул больше не принимает задачи, поднимаем новый
+                with self._lock:
+                    if self.executor is executor:
+                        print("VisualizationLayer: Render worker died, restarting the pool")
+                        # Сломанный пул отпускает оставшиеся процессы и их дескрипторы, а не копит их
+                        executor.shutdown(wait=False, cancel_futures=True)
+                        self._start_executor()
+                raise
+            except FutureTimeoutError:
+                # Зависший рендер прервать нельзя, но ждать его дальше и держать слот вызывающий не будет
+                future.cancel()
+                metrics.inc("chart_render_timeouts_total", chart=chart)
+                raise TimeoutError(f"Chart {chart} was not rendered in {self.timeout}s")
+        finally:
+            with self._lock:
+                self._pending -= 1
+            self._slots.release()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ChartCache:
+    """LRU-кэш PNG-картинок, ограниченный суммарным размером в байтах."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            png = self._entries.get(key)
+            if png is not None:
+                self._entries.move_to_end(key)
+            return png
+
+    def put(self, key, png):
+        if len(png) > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._entries[key] = png
+            self.size += len(png)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class VisualizationLayer:
+    def __init__(self, db_layer, render_pool=None, data_source=None):
+        self.db_layer = db_layer
+        load_dotenv()
+        self.chart_cache = ChartCache(int(os.getenv("CHART_CACHE_MAX_BYTES", str(32 * 1024 * 1024))))
+        self.render_pool = render_pool or ChartRenderPool()
+        # Откуда берутся данные графиков: db — запросы к базе, replica — локальная колоночная реплика
+        self.data_source = data_source or os.getenv("CHART_DATA_SOURCE", "db")
+        self.replica = None
+        if self.data_source == "replica":
+            # Импортируем только в режиме реплики
+            from layers.replica_layer import ReplicaLayer
+            self.replica = ReplicaLayer(db_layer)
+            self.source = self.replica
+        elif self.data_source == "db":
+            self.source = db_layer
         else:
-            df = pd.DataFrame(data, columns=["session_id", "avg_result"])
-            plt.plot(df["session_id"], df["avg_result"], marker="o")
-
-        plt.xlabel("Session ID")
-        plt.ylabel("Average Roll Result")
-        plt.title("Average Roll Result by Session")
-        plt.grid(True)
-        plt.savefig(f'charts/{filename}')
-        plt.close()
-
-        return filename
-
-    def plot_average_rolls_by_player(self, last_session=None, session_num=None, filename="average_rolls_by_player.png"):
-        """Bar-диаграмма средних значений бросков по игрокам."""
-        plt.figure(figsize=(8, 6))
-        data = self.db_layer.get_average_rolls_by_player(last_session, session_num)
-        df = pd.DataFrame(data, columns=["user_name", "avg_result"])
-
-        plt.bar(df["user_name"], df["avg_result"])
-        plt.xlabel("Player")
-        plt.ylabel("Average Roll Result")
-        plt.title("Average Roll Result by Player" +
-                  (" (Last Session)" if last_session else f" (Session {session_num})" if session_num is not None else ""))
-        plt.xticks(rotation=45)
-        plt.savefig(f'charts/{filename}')
-        plt.close()
-
-        return filename
-
-    def plot_critical_rolls_by_player(self, last_session=None, session_num=None, filename="critical_rolls_by_player.png"):
-        """Bar-диаграмма критических удач и неудач по игрокам."""
-        plt.figure(figsize=(8, 6))
-        data = self.db_layer.get_critical_rolls_by_player(last_session, session_num)
-        df = pd.DataFrame(data, columns=["user_name", "critical_success", "critical_failure"])
-
-        bar_width = 0.35
-        x = range(len(df["user_name"]))
-        plt.bar(x, df["critical_success"], bar_width, label="Critical Success (3-4)", color="green")
-        plt.bar([i + bar_width for i in x], df["critical_failure"], bar_width, label="Critical Failure (17-18)", color="red")
-        plt.xlabel("Player")
-        plt.ylabel("Count")
-        plt.title("Critical Rolls by Player" +
-                  (" (Last Session)" if last_session else f" (Session {session_num})" if session_num is not None else ""))
-        plt.xticks([i + bar_width / 2 for i in x], df["user_name"], rotation=45)
-        plt.legend()
-        plt.savefig(f'charts/{filename}')
-        plt.close()
-
-        return filename
-
-    def plot_session_durations(self, by_week=False, filename="session_durations.png"):
-        plt.figure(figsize=(10, 6))
-
-        if by_week:
-            # Вариант 2: по неделям
-            data = self.db_layer.get_weekly_session_durations()
-            df = pd.DataFrame(data, columns=["week_start", "total_hours"])
-            plt.plot(df["week_start"], df["total_hours"], marker="o")
-            plt.xlabel("Неделя")
-            plt.ylabel("Общая длительность (часы)")
-            plt.title("Длительность игровых сессий по неделям")
-            plt.xticks(rotation=45)
+            raise ValueError(f"Unknown chart data source: {self.data_source}. Expected db or replica")
+
+    def _source_version(self):
+        """
+        Версия данных источника графиков. Реплику график не ждёт: фоновый поток только получает сигнал
+        проверить базу, а график строится по уже синхронизированным колонкам.
+        """
+        if self.replica is not None:
+            self.replica.request_sync()
+        return self.source.data_version.value
+
+    def _render_cached(self, chart, params, fetch):
+        """
+        Отдаёт PNG из кэша или запрашивает данные функцией fetch и отдаёт их на отрисовку в пул.
+        Версия данных читается до запроса: если запись случится во время отрисовки, картинка ляжет под старой
+        версией и следующий запрос её перерисует.
+        """
+        key = (chart, params, self._source_version())
+        png = self.chart_cache.get(key)
+        if png is not None:
+            metrics.inc("chart_cache_total", chart=chart, result="hit")
+            return png
+
+        metrics.inc("chart_cache_total", chart=chart, result="miss")
+        png = self.render_pool.render(chart, fetch(), params)
+        self.chart_cache.put(key, png)
+        return png
+
+    @metrics.timed("chart_render_duration_seconds", chart="average_rolls_by_session")
+    def plot_average_rolls_by_session(self, by_players=None):
+        """Линейный график средних значений бросков по сессиям. Возвращает PNG-байты."""
+        by_players = bool(by_players)
+        return self._render_cached("average_rolls_by_session", (by_players,),
+                                   lambda: self.source.get_average_rolls_by_session(by_players))
+
+    @metrics.timed("chart_render_duration_seconds", chart="average_rolls_by_player")
+    def plot_average_rolls_by_player(self, last_session=None, session_num=None):
+        """Bar-диаграмма средних значений бросков по игрокам. Возвращает PNG-байты."""
+        last_session = bool(last_session)
+        return self._render_cached("average_rolls_by_player", (last_session, session_num),
+                                   lambda: self.source.get_average_rolls_by_player(last_session, session_num))
+
+    @metrics.timed("chart_render_duration_seconds", chart="critical_rolls_by_player")
+    def plot_critical_rolls_by_player(self, last_session=None, session_num=None):
+        """Bar-диаграмма критических удач и неудач по игрокам. Возвращает PNG-байты."""
+        last_session = bool(last_session)
+        return self._render_cached("critical_rolls_by_player", (last_session, session_num),
+                                   lambda: self.source.get_critical_rolls_by_player(last_session, session_num))
+
+    @metrics.timed("chart_render_duration_seconds", chart="session_durations")
+    def plot_session_durations(self, by_week=False):
+        """Линейный график длительности сессий, по сессиям или по неделям. Возвращает PNG-байты."""
+        by_week = bool(by_week)
+        fetch = self.source.get_weekly_session_durations if by_week else self.source.get_session_durations
+        return self._render_cached("session_durations", (by_week,), fetch)
+
+    @metrics.timed("chart_render_duration_seconds", chart="dice_fairness")
+    def plot_dice_fairness(self, by_session=False, last_session=None, session_num=None):
+        """Диаграмма честности костей по игрокам или по сессиям. Возвращает PNG-байты."""
+        by_session, last_session = bool(by_session), bool(last_session)
+
+        def fetch():
+            counts = self.source.get_dice_face_counts(last_session, session_num)
+            groups = counts["sessions"] if by_session else counts["players"]
+            return {
+                "all": (counts["all"],) + chi_square_fairness(counts["all"]),
+                "groups": [(label, group_counts) + chi_square_fairness(group_counts) for label, group_counts in groups],
+            }
+
+        return self._render_cached("dice_fairness", (by_session, last_session, session_num), fetch)
+
+    def render_batch(self, variants=CHART_VARIANTS):
+        """
+        Пакетная отрисовка: один снимок данных, все варианты считаются из него в памяти и рисуются в пуле
+        параллельно. Кэш используется в обе стороны: уже готовые варианты не перерисовываются, а новые кладутся
+        под версией данных снимка для последующих одиночных команд. График, который не удалось построить
+        (очередь рендера занята, таймаут), не срывает остальные. Возвращает ({имя файла: PNG}, {имя файла: ошибка}).
+        """
+        version = self._source_version()
+        charts = {}
+        missing = []
+        for filename, chart, params in variants:
+            png = self.chart_cache.get((chart, params, version))
+            if png is None:
+                missing.append((filename, chart, params))
+            else:
+                charts[filename] = png
+        failures = {}
+        if not missing:
+            return charts, failures
+
+        snapshot = self.source.get_chart_snapshot()
+
+        def render(variant):
+            filename, chart, params = variant
+            try:
+                png = self.render_pool.render(chart, derive_chart_data(snapshot, chart, params), params)
+            except Exception as e:
+                return filename, None, e
+            self.chart_cache.put((chart, params, version), png)
+            return filename, png, None
+
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            for filename, png, error in executor.map(render, missing):
+                if error is None:
+                    charts[filename] = png
+                else:
+                    failures[filename] = error
+        return charts, failures
+
+    def save_all_plots(self, batch=True):
+        """
+        Сохраняет все вариации графиков в папку test_all_charts. Возвращает время пакета в секундах
+        и {имя файла: ошибка} для графиков, которые не построились.
+        batch=False — прежний последовательный путь, по запросу к базе на каждый график.
+        """
+        started = time.perf_counter()
+        if batch:
+            charts, failures = self.render_batch()
         else:
-            # Вариант 1: по сессиям
-            data = self.db_layer.get_session_durations()
-            df = pd.DataFrame(data, columns=["session_id", "duration_hours"])
-            plt.plot(df["session_id"], df["duration_hours"], marker="o")
-            plt.xlabel("номер сессии")
-            plt.ylabel("Длительность (часы)")
-            plt.title("Длительность игровых сессий")
-
-        # Добавляем форматирование оси Y для отображения только целых чисел
-        plt.gca().xaxis.set_major_locator(plt.MaxNLocator(integer=True))
-
-        plt.grid(True)
-        plt.tight_layout()
-        plt.savefig(filename)
-        plt.close()
-        return filename
-
-    def save_all_plots(self):
-        """Сохраняет все вариации графиков в папку test_all_charts."""
-        os.makedirs("../test_all_charts", exist_ok=True)
+            charts, failures = {}, {}
+            for filename, chart, params in CHART_VARIANTS:
+                try:
+                    charts[filename] = getattr(self, f"plot_{chart}")(*params)
+                except Exception as e:
+                    failures[filename] = e
+        for filename, error in failures.items():
+            print(f"VisualizationLayer: {filename} was not rendered: {error!r}")
 
-        self.plot_average_rolls_by_session(filename="../test_all_charts/average_rolls_by_session.png")
-        self.plot_average_rolls_by_session(by_players=True, filename="../test_all_charts/average_rolls_by_session_by_players.png")
-        self.plot_average_rolls_by_player(filename="../test_all_charts/average_rolls_by_player.png")
-        self.plot_average_rolls_by_player(last_session=True, filename="../test_all_charts/average_rolls_by_player_last_session.png")
-        self.plot_average_rolls_by_player(session_num=1, filename="../test_all_charts/average_rolls_by_player_session_1.png")
-        self.plot_critical_rolls_by_player(filename="../test_all_charts/critical_rolls_by_player.png")
-        self.plot_critical_rolls_by_player(last_session=True, filename="../test_all_charts/critical_rolls_by_player_last_session.png")
-        self.plot_critical_rolls_by_player(session_num=1, filename="../test_all_charts/critical_rolls_by_player_session_1.png")
-        print("All plots saved in test_all_charts directory.")
\ No newline at end of file
+        os.makedirs("../test_all_charts", exist_ok=True)
+        for filename, png in charts.items():
+            with open(os.path.join("../test_all_charts", filename), "wb") as f:
+                f.write(png)
+        elapsed = time.perf_counter() - started
+        metrics.observe("chart_batch_duration_seconds", elapsed, mode="batch" if batch else "serial")
+        print(f"VisualizationLayer: {len(charts)} plots saved in test_all_charts directory in {elapsed:.2f}s")
+        return elapsed, failures
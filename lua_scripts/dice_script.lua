@@ -3,10 +3,14 @@
 -- Tabletop Simulator и ограчен ею
 
 local ZONE_GUID = "e84e08" -- GUID твоей зоны (замени на актуальный GUID)
+-- Имя стола: у каждого стола, подключённого к одному серверу, должно быть своё
+local TABLE_ID = "default"
 local diceResults = {}
 local zone = nil
 local errorShown = false
 local sessionActive = false
+-- Счётчик бросков для roll_id: сервер записывает бросок с одним roll_id в сессии только один раз
+local rollCounter = 0
 
 function onLoad()
     print("onLoad: Starting initialization...")
@@ -128,10 +132,12 @@ function sendResults(player, diceList)
         total = total + result
         table.insert(results, result)
     end
+    rollCounter = rollCounter + 1
     local rollData = {
         player = player,
         results = results,
-        total = total
+        total = total,
+        roll_id = os.time() .. "-" .. rollCounter
     }
     local jsonData = JSON.encode(rollData)
     print("sendResults: Sending data: " .. jsonData)
@@ -147,7 +153,7 @@ function sendResults(player, diceList)
                 print("sendResults: Success: Data sent to server")
             end
         end,
-        { ["Content-Type"] = "application/json" }
+        { ["Content-Type"] = "application/json", ["X-Table-Id"] = TABLE_ID }
     )
     diceResults = {}
     errorShown = false
@@ -167,7 +173,7 @@ function onChat(message, player)
                     print("onChat: New session started!")
                 end
             end,
-            { ["Content-Type"] = "application/json" }
+            { ["Content-Type"] = "application/json", ["X-Table-Id"] = TABLE_ID }
         )
     end
 
@@ -184,7 +190,7 @@ function onChat(message, player)
                     print("onChat: session closed!")
                 end
             end,
-            { ["Content-Type"] = "application/json" }
+            { ["Content-Type"] = "application/json", ["X-Table-Id"] = TABLE_ID }
         )
     end
 end
\ No newline at end of file
@@ -1,32 +1,174 @@
-from layers.db_layer import DBLayer
-from layers.api_layer import APILayer
-from layers.bot_layer import BotLayer
-from layers.msg_broker_layer import MsgBrokerLayer
+from layers.startup_layer import StartupOrchestrator
+import argparse
+import os
 import threading
 
-def main():
-    # Инициализация слоёв
+# Слои импортируются внутри шагов запуска: тяжёлые библиотеки (discord, flask, pika, psycopg2)
+# загружаются параллельно, а графики (pandas, matplotlib) — только при первом графике
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Сервис сбора и визуализации бросков из Tabletop Simulator")
+    parser.add_argument(
+        "--server", choices=("flask", "async"), default=os.getenv("SERVER_MODE", "flask"),
+        help="flask — сервер разработки со Swagger, async — aiohttp с asyncpg/aio-pika для высокой нагрузки"
+    )
+    parser.add_argument(
+        "--rebuild-rollups", action="store_true",
+        help="пересчитать агрегаты session_player_rollups по всей истории бросков и выйти"
+    )
+    parser.add_argument("--export", metavar="DIR", help="выгрузить историю игр в каталог DIR и выйти")
+    parser.add_argument("--export-format", choices=("csv", "parquet"), default="csv",
+                        help="формат выгрузки; parquet требует pyarrow")
+    parser.add_argument("--import", dest="import_dir", metavar="DIR",
+                        help="загрузить выгрузку из каталога DIR в базу и выйти")
+    parser.add_argument("--import-log", nargs="+", metavar="FILE",
+                        help="загрузить журналы бросков JSON Lines в базу и выйти")
+    return parser.parse_args()
+
+def create_api_layer(server):
+    if server == "async":
+        # Импортируем только в async-режиме, чтобы Flask-режиму не требовались aiohttp/asyncpg/aio-pika
+        from layers.async_api_layer import AsyncAPILayer
+        return AsyncAPILayer()
+    from layers.api_layer import APILayer
+    # Сервер занимает порт сразу; пока база и брокер не подключены, маршруты приёма отвечают 503
+    api_layer = APILayer(None, None)
+    api_layer.start_server()
+    return api_layer
+
+def connect_database():
+    from layers.db_layer import DBLayer
     db_layer = DBLayer()
-    broker_layer = MsgBrokerLayer(db_layer)  # Добавляем MsgBrokerLayer
-    api_layer = APILayer(db_layer, broker_layer)
-    bot_layer = BotLayer(db_layer)  # Передаём db_layer
+    db_layer.ensure_schema()
+    db_layer.warm_user_cache()
+    return db_layer
+
+def connect_broker(db_layer):
+    from layers.msg_broker_layer import MsgBrokerLayer
+    return MsgBrokerLayer(db_layer)
 
+def load_stats(db_layer):
+    from layers.stats_layer import StatsEngine
+    stats_engine = StatsEngine()
+    stats_engine.rebuild(db_layer)
+    # Подписка до открытия приёма и до запуска спула: в базу ещё никто не пишет, броски не теряются и не двоятся
+    db_layer.roll_listeners.append(stats_engine.record_rolls)
+    return stats_engine
+
+def start_spool(db_layer):
+    from layers.spool_layer import SpoolLayer
+    spool_layer = SpoolLayer(db_layer)
+    spool_layer.start()
+    return spool_layer
+
+def import_bot():
+    from layers.bot_layer import BotLayer
+    return BotLayer
+
+def start_bot(bot_class, db_layer):
+    bot_layer = bot_class(db_layer)  # Передаём db_layer
     # Запуск бота в отдельном потоке
     bot_thread = threading.Thread(target=bot_layer.run)
     bot_thread.daemon = True
     bot_thread.start()
+    return bot_layer
+
+def start_live_feed(bot_layer, broker_layer):
+    # Без LIVE_FEED_CHANNEL_ID лента выключена; события бросков публикует API при ROLL_EVENTS=1
+    return bot_layer.start_live_feed(broker_layer)
+
+def main():
+    args = parse_args()
 
-    # Запуск ngrok
-    public_url = api_layer.start_ngrok()
-    if not public_url:
+    if args.rebuild_rollups:
+        from layers.db_layer import DBLayer
+        db_layer = DBLayer()
+        db_layer.ensure_schema(backfill=False)
+        db_layer.rebuild_rollups()
         db_layer.close()
         return
 
-    # Запуск Flask-сервера
+    if args.export or args.import_dir or args.import_log:
+        from layers.archive_layer import ArchiveLayer
+        from layers.db_layer import DBLayer
+        db_layer = DBLayer()
+        db_layer.ensure_schema()
+        archive_layer = ArchiveLayer(db_layer)
+        try:
+            if args.export:
+                archive_layer.export(args.export, args.export_format)
+            elif args.import_dir:
+                archive_layer.import_archive(args.import_dir)
+            else:
+                archive_layer.import_roll_log(args.import_log)
+        finally:
+            db_layer.close()
+        return
+
+    startup = StartupOrchestrator()
+    api_layer = startup.run("http", create_api_layer, args.server)
+
+    # Независимые шаги идут параллельно, брокер и бот ждут только базу
+    database = startup.step("database", connect_database)
+    broker = startup.step("broker", connect_broker, after=(database,))
+    bot_class = startup.step("bot_import", import_bot)
+    bot = startup.step("bot", start_bot, after=(bot_class, database))
+    tunnel = startup.step("tunnel", api_layer.start_ngrok)
+    live_feed = startup.step("live_feed", start_live_feed, after=(bot, broker))
+    # Статистика в памяти питается записями DBLayer; async-сервер пишет через asyncpg мимо него
+    stats = startup.step("stats", load_stats, after=(database,)) if args.server == "flask" else None
+
+    api_layer.readiness_checks.update({
+        "database": lambda: startup.is_done(database),
+        "broker": lambda: startup.is_done(broker),
+        "bot": lambda: startup.is_done(bot) and bot.result().ready.is_set(),
+        "tunnel": lambda: startup.is_done(tunnel) and tunnel.result() is not None,
+    })
+
+    db_layer = None
+    spool_layer = None
     try:
-        api_layer.run()
+        try:
+            db_layer = database.result()
+            broker_layer = broker.result()
+            if args.server == "async":
+                # Общий с DBLayer счётчик изменений, чтобы кэш графиков бота видел записи этого сервера
+                api_layer.data_version = db_layer.data_version
+            else:
+                stats_engine = stats.result()
+                # Спул нужен как основной путь приёма (INGEST_MODE=spool) или как запасной (SPOOL_FALLBACK)
+                if api_layer.uses_spool:
+                    spool_layer = startup.run("spool", start_spool, db_layer)
+                api_layer.attach(db_layer, broker_layer, spool_layer, stats_engine)
+
+            # В write-behind режиме броски из очереди пишут в базу консьюмеры брокера
+            if api_layer.write_behind:
+                startup.run("consumers", broker_layer.run)
+
+            bot.result()
+            live_feed.result()
+            public_url = tunnel.result()
+        except Exception as e:
+            print(f"Startup failed: {e}")
+            return
+        finally:
+            startup.report()
+            startup.shutdown()
+        if not public_url:
+            return
+
+        if args.server == "async":
+            api_layer.run()
+        else:
+            # Flask-сервер уже слушает порт в своём потоке
+            api_layer.server_thread.join()
     finally:
-        db_layer.close()
+        if args.server != "async":
+            api_layer.stop_server()
+        if spool_layer is not None:
+            spool_layer.close()
+        if db_layer is not None:
+            db_layer.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()